@@ -0,0 +1,46 @@
+"""
+Fonts and images, loaded on first use and shared from then on.
+
+Looking up a system font scans all fonts on the system, and the logo is needed again on every reset, so neither
+should happen more than once. Safe to call from any thread, a second caller waits for the first one's result.
+
+@author: Jeroen Vlek <j.vlek@anchormen.nl>
+"""
+
+import threading
+
+import pygame
+
+_lock = threading.Lock()
+_fonts = {}
+_images = {}
+
+
+def load_font(name, size):
+    """
+    Returns the system font `name` at `size` points, or pygame's default font if it isn't installed
+    """
+    key = (name, size)
+    with _lock:
+        font = _fonts.get(key)
+        if font is None:
+            if not pygame.font.get_init():
+                pygame.font.init()
+            font = _fonts[key] = pygame.font.SysFont(name, size)
+        return font
+
+
+def load_image(path, size=None):
+    """
+    Returns the image at `path`, scaled to `size` if given. The surface is shared, so don't draw onto it.
+    """
+    key = (path, tuple(size) if size else None)
+    with _lock:
+        image = _images.get(key)
+        if image is None:
+            image = _images.get((path, None))
+            if image is None:
+                image = _images[(path, None)] = pygame.image.load(path)
+            if size:
+                image = _images[key] = pygame.transform.scale(image, size)
+        return image
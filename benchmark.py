@@ -0,0 +1,289 @@
+"""
+Headless benchmarks built around the real game loop. Runs without a camera, OpenPose or a display.
+
+Usage: python3 benchmark.py replay session.zip [--real_time]
+       python3 benchmark.py display [--width 1920 --height 1080]
+       python3 benchmark.py resolution [--net_resolution -1x368 --cost_per_megapixel 0.05]
+       python3 benchmark.py crowd [--players 1,2,5,10,20,30,40,50]
+
+@author: Jeroen Vlek <j.vlek@anchormen.nl>
+"""
+
+import argparse
+import json
+import os
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import cv2
+import numpy as np
+import pygame
+
+from camera import CapturedFrame
+from constants import DT, FRAME_RATE_CAP
+from display import FramePresenter
+from entities import PlayerStore
+from game import PoseLogoSlapGame
+from physics import World
+from pose_estimator import PoseEstimator, RegionOfInterest, SyntheticBackend, parse_net_resolution
+from session import SessionReader, ReplayClock, ReplayGrabber, ReplayInference
+
+
+def summarize(samples):
+    """
+    Mean and percentiles of a list of durations, in milliseconds
+    """
+    if not samples:
+        return {}
+
+    samples = np.asarray(samples) * 1000.0
+    return {"mean": float(np.mean(samples)),
+            "p50": float(np.percentile(samples, 50)),
+            "p90": float(np.percentile(samples, 90)),
+            "p99": float(np.percentile(samples, 99)),
+            "max": float(np.max(samples))}
+
+
+def print_report(name, report):
+    print(name)
+    for key, value in report.items():
+        if isinstance(value, dict):
+            print("  %-20s %s" % (key, "  ".join("%s=%.3f" % item for item in value.items())))
+        else:
+            print("  %-20s %s" % (key, value))
+
+
+class BenchmarkGame(PoseLogoSlapGame):
+    """
+    The game, timing its physics steps
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.physics_times = []
+
+    def step_physics(self, frame_time):
+        start = time.perf_counter()
+        super().step_physics(frame_time)
+        self.physics_times.append(time.perf_counter() - start)
+
+
+def replay(args):
+    reader = SessionReader(args.session)
+    clock = ReplayClock(reader.start_time, args.real_time, args.speed)
+    grabber = ReplayGrabber(reader, clock)
+    inference = ReplayInference(reader, clock) if reader.poses else None
+    # With poses the game takes its frames from the inference results, otherwise straight from the grabber
+    event_source = inference if inference else grabber
+
+    screen_dims = (args.width, args.height)
+    first_frame = reader.frame(reader.frames[0][0]) if reader.frames else None
+    if first_frame is not None:
+        screen_dims = (first_frame.shape[1], first_frame.shape[0])
+
+    game = BenchmarkGame(screen_dims, args.image_path, None, grabber, False, False, inference)
+    game.time_source = clock.now
+    game.init_game()
+
+    tick_times = []
+    start = time.perf_counter()
+    previous_time = clock.now()
+    while clock.now() < reader.end_time:
+        if not args.real_time:
+            # Jump straight to the next recorded event, decoding its frame outside of the measurement
+            upcoming = event_source.next_event()
+            if upcoming is None:
+                break
+            reader.frame(upcoming[0])
+            clock.advance_to(upcoming[1])
+
+        now = clock.now()
+        tick_start = time.perf_counter()
+        game.tick(now - previous_time)
+        tick_times.append(time.perf_counter() - tick_start)
+        previous_time = now
+
+        if args.real_time:
+            game.clock.tick(FRAME_RATE_CAP)
+    elapsed = time.perf_counter() - start
+
+    report = {"session": args.session,
+              "mode": "real time" if args.real_time else "max speed",
+              "frames": len(tick_times),
+              "fps": len(tick_times) / elapsed if elapsed > 0 else 0.0,
+              "frame_ms": summarize(tick_times),
+              "physics_ms": summarize(game.physics_times)}
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print_report("replay", report)
+
+    pygame.quit()
+    reader.close()
+
+
+def legacy_present(screen, frame):
+    """
+    The display path before FramePresenter, kept as the baseline
+    """
+    pixels = np.swapaxes(frame, 0, 1).astype(np.uint8)
+    pixels = np.flip(pixels, axis=2)
+    pygame.surfarray.blit_array(screen, pixels)
+
+
+def display(args):
+    pygame.init()
+    screen = pygame.display.set_mode((args.width, args.height))
+    frames = [np.random.randint(0, 256, (args.height, args.width, 3), dtype=np.uint8) for _ in range(4)]
+    presenter = FramePresenter(screen)
+
+    report = {"resolution": "%dx%d" % (args.width, args.height)}
+    for name, present in [("legacy_ms", legacy_present), ("presenter_ms", lambda _, frame: presenter.present(frame))]:
+        times = []
+        for i in range(args.frames):
+            start = time.perf_counter()
+            present(screen, frames[i % len(frames)])
+            times.append(time.perf_counter() - start)
+        report[name] = summarize(times)
+
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print_report("display", report)
+
+    pygame.quit()
+
+
+def resolution(args):
+    """
+    Compares running the estimator on full frames, on frames downscaled to the net resolution and on a region of
+    interest within those. The synthetic backend's cost scales with the number of pixels it gets, like a real one.
+    """
+    frame = np.random.randint(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+    inference_size = parse_net_resolution(args.net_resolution, args.width, args.height)
+
+    report = {"resolution": "%dx%d" % (args.width, args.height), "inference_size": "%dx%d" % inference_size}
+    for mode in ("full", "downscale", "roi"):
+        backend = SyntheticBackend(args.players, cost_per_megapixel=args.cost_per_megapixel)
+        estimator = PoseEstimator(backend, RegionOfInterest() if mode == "roi" else None)
+        capture_times = []
+        estimate_times = []
+        input_bytes = 0
+        for seq in range(args.frames):
+            start = time.perf_counter()
+            inference_image = None
+            if mode != "full":
+                inference_image = cv2.resize(frame, inference_size, interpolation=cv2.INTER_AREA)
+            captured = CapturedFrame(seq, time.monotonic(), frame, inference_image)
+            capture_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            estimator.estimate(captured)
+            estimate_times.append(time.perf_counter() - start)
+
+            if estimator.roi and estimator.roi.box is not None:
+                x0, y0, x1, y1 = estimator.roi.box
+                input_bytes += (x1 - x0) * (y1 - y0) * 3
+            elif inference_image is not None:
+                input_bytes += inference_image.nbytes
+            else:
+                input_bytes += frame.nbytes
+
+        report[mode] = {"capture_ms": summarize(capture_times)["mean"],
+                        "estimate_ms": summarize(estimate_times)["mean"],
+                        "estimate_p99_ms": summarize(estimate_times)["p99"],
+                        "kb_per_frame": input_bytes / 1024.0 / args.frames}
+
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print_report("resolution", report)
+
+
+def crowd(args):
+    """
+    Times moving the hands and a physics step with a growing number of synthetic players, in the default space and in
+    crowd mode. The game culls the push bodies once per frame, here it's counted in with every step, so crowd mode is
+    timed at its worst.
+    """
+    screen_dims = (args.width, args.height)
+    report = {}
+    for num_players in [int(value) for value in args.players.split(",")]:
+        backend = SyntheticBackend(num_players, time_step=DT)
+        for mode in ("default", "crowd"):
+            crowd_players = num_players if mode == "crowd" else None
+            world = World(screen_dims, pool_size=2 * num_players, crowd_players=crowd_players)
+            world.spawn_logo()
+            store = PlayerStore(world.push_bodies)
+            players = [store.add(track_id) for track_id in range(num_players)]
+
+            hand_times = []
+            step_times = []
+            culled = 0
+            for step in range(args.steps):
+                key_points = backend.skeletons(step * DT, *screen_dims)
+                start = time.perf_counter()
+                store.update_poses(players, key_points, DT)
+                hand_times.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                if world.crowd_mode:
+                    world.cull_push_bodies()
+                world.space.step(DT)
+                step_times.append(time.perf_counter() - start)
+                culled += world.culled_count
+
+            report["%s_%d" % (mode, num_players)] = {"hands_ms": summarize(hand_times)["mean"],
+                                                     "step_ms": summarize(step_times)["mean"],
+                                                     "step_p99_ms": summarize(step_times)["p99"],
+                                                     "culled": culled / float(args.steps)}
+
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print_report("crowd", report)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless benchmarks for the game')
+    parser.add_argument("--json", action="store_true", help="If provided, prints the report as a JSON line")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    replay_parser = subparsers.add_parser("replay", help="Replays a session recorded with game.py --record")
+    replay_parser.add_argument("session", help="Path to the session file")
+    replay_parser.add_argument("--real_time", action="store_true",
+                               help="If provided, replays at recorded speed instead of as fast as possible")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="Replay speed factor in real time mode")
+    replay_parser.add_argument("--image_path", default="logo.png", help="Path to the logo")
+    replay_parser.add_argument('--width', type=int, default=1280, help='Display width if the session has no frames')
+    replay_parser.add_argument('--height', type=int, default=720, help='Display height if the session has no frames')
+    replay_parser.set_defaults(func=replay)
+
+    display_parser = subparsers.add_parser("display", help="Times getting a camera frame onto the screen")
+    display_parser.add_argument('--width', type=int, default=1280, help='Frame and display width')
+    display_parser.add_argument('--height', type=int, default=720, help='Frame and display height')
+    display_parser.add_argument('--frames', type=int, default=300, help='Number of frames to present')
+    display_parser.set_defaults(func=display)
+
+    resolution_parser = subparsers.add_parser("resolution", help="Compares full frame, downscaled and ROI inference")
+    resolution_parser.add_argument('--width', type=int, default=1280, help='Captured frame width')
+    resolution_parser.add_argument('--height', type=int, default=720, help='Captured frame height')
+    resolution_parser.add_argument("--net_resolution", default="-1x368", help="Inference resolution")
+    resolution_parser.add_argument("--players", type=int, default=2, help="Number of synthetic skeletons")
+    resolution_parser.add_argument("--cost_per_megapixel", type=float, default=0.05,
+                                   help="Seconds the synthetic estimator spends per million input pixels")
+    resolution_parser.add_argument('--frames', type=int, default=100, help='Number of frames to estimate')
+    resolution_parser.set_defaults(func=resolution)
+
+    crowd_parser = subparsers.add_parser("crowd", help="Times physics steps as the number of players grows")
+    crowd_parser.add_argument('--width', type=int, default=1280, help='Field width')
+    crowd_parser.add_argument('--height', type=int, default=720, help='Field height')
+    crowd_parser.add_argument("--players", default="1,2,5,10,20,30,40,50", help="Comma separated numbers of players")
+    crowd_parser.add_argument('--steps', type=int, default=600, help='Number of physics steps per measurement')
+    crowd_parser.set_defaults(func=crowd)
+
+    args = parser.parse_args()
+    args.func(args)
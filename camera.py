@@ -3,56 +3,355 @@
 @author: Jeroen Vlek <j.vlek@anchormen.nl>
 """
 
+import collections
 import logging
 import queue
 import threading
+import time
 
 import cv2
+import numpy as np
 
+from constants import CAMERA_BUFFER_SIZE, CAMERA_FOURCC, FAILED_READ_BACKOFF, FRAME_BUFFER_SIZE, MAX_FRAME_AGE, \
+    VIDEO_DECODE_QUEUE_SIZE
+from metrics import registry
 
-def setup_camera_streaming(width, height, cam_id=0, fps=30):
-    """ Sets up capture with width, height and frames per second parameters """
+CapturedFrame = collections.namedtuple('CapturedFrame', ['seq', 'timestamp', 'image', 'inference_image'])
+# The downscaled copy for the pose estimator is optional
+CapturedFrame.__new__.__defaults__ = (None,)
+
+
+def setup_camera_streaming(width, height, cam_id=0, fps=30, fourcc=CAMERA_FOURCC, buffer_size=CAMERA_BUFFER_SIZE):
+    """ Sets up capture with width, height and frames per second parameters, plus codec and internal buffer size """
     capture = cv2.VideoCapture(cam_id)
+    if not capture.isOpened():
+        raise Exception("Failed to initialize camera %s" % cam_id)
+
+    # The codec goes first, some drivers only offer the higher resolutions and frame rates for MJPG
+    if fourcc:
+        capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+    capture.set(cv2.CAP_PROP_BUFFERSIZE, buffer_size)
     capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
     capture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
     capture.set(cv2.CAP_PROP_FPS, fps)
-    if not capture:
-        raise Exception("Failed to initialize camera")
 
     return capture
 
 
+def fourcc_name(code):
+    code = int(code)
+    return "".join(chr((code >> shift) & 0xFF) for shift in (0, 8, 16, 24))
+
+
+class FrameSource(object):
+    """
+    Something that produces BGR frames, one per `read`, and keeps track of how many per second it actually delivers
+    """
+
+    def __init__(self):
+        self.read_times = collections.deque(maxlen=30)
+        self.frames = 0
+
+    def read(self):
+        """
+        Returns whether a frame was read, and the frame
+        """
+        raise NotImplementedError
+
+    def release(self):
+        pass
+
+    def count_frame(self):
+        self.frames += 1
+        self.read_times.append(time.monotonic())
+
+    def throughput(self):
+        """
+        Frames per second delivered recently
+        """
+        if len(self.read_times) < 2:
+            return 0.0
+
+        return (len(self.read_times) - 1) / max(self.read_times[-1] - self.read_times[0], 1e-6)
+
+
+class CameraSource(FrameSource):
+    """
+    A V4L2 (or other) camera, asking for the given codec, a small internal buffer so frames aren't queued up, and the
+    given resolution and frame rate. What the driver actually agreed to is logged and kept as `settings`.
+    """
+
+    def __init__(self, width, height, cam_id=0, fps=30, fourcc=CAMERA_FOURCC, buffer_size=CAMERA_BUFFER_SIZE):
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.capture = setup_camera_streaming(width, height, cam_id, fps, fourcc, buffer_size)
+
+        self.settings = {"width": int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                         "height": int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                         "fps": self.capture.get(cv2.CAP_PROP_FPS),
+                         "fourcc": fourcc_name(self.capture.get(cv2.CAP_PROP_FOURCC)),
+                         "buffer_size": int(self.capture.get(cv2.CAP_PROP_BUFFERSIZE))}
+        requested = {"width": width, "height": height, "fps": fps, "fourcc": fourcc, "buffer_size": buffer_size}
+        for name, value in sorted(requested.items()):
+            if value and self.settings[name] and self.settings[name] != value:
+                self.logger.warning("Camera %s: asked for %s %s, got %s", cam_id, name, value, self.settings[name])
+        self.logger.info("Camera %s: %s", cam_id, self.settings)
+
+    def read(self):
+        success, frame = self.capture.read()
+        if success:
+            self.count_frame()
+        return success, frame
+
+    def release(self):
+        self.capture.release()
+
+
+class VideoFileSource(FrameSource):
+    """
+    Decodes a video file on a background thread, delivering frames at the file's own frame rate, or as fast as they
+    can be decoded if `real_time` is off. Starts over at the end if `loop` is on.
+    """
+
+    def __init__(self, path, size=None, real_time=True, loop=True, queue_size=VIDEO_DECODE_QUEUE_SIZE):
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise Exception("Failed to open video file %s" % path)
+
+        self.path = path
+        self.size = size
+        self.real_time = real_time
+        self.loop = loop
+        self.native_fps = self.capture.get(cv2.CAP_PROP_FPS) or 30.0
+        self.logger.info("Video %s at %.1f fps", path, self.native_fps)
+
+        self.decoded = queue.Queue(maxsize=queue_size)
+        self.running = True
+        self.next_frame_time = None
+        self.decoder = threading.Thread(target=self.decode, daemon=True)
+        self.decoder.start()
+
+    def decode(self):
+        while self.running:
+            success, frame = self.capture.read()
+            if not success:
+                if self.loop and self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0):
+                    time.sleep(FAILED_READ_BACKOFF)
+                    continue
+                self.decoded.put(None)
+                return
+
+            if self.size and (frame.shape[1], frame.shape[0]) != tuple(self.size):
+                frame = cv2.resize(frame, tuple(self.size))
+            self.decoded.put(frame)
+
+    def read(self):
+        frame = self.decoded.get()
+        if frame is None:
+            # Keep failing at the end of the file
+            self.decoded.put(None)
+            return False, None
+
+        if self.real_time:
+            now = time.monotonic()
+            if self.next_frame_time is None or self.next_frame_time < now - 1.0 / self.native_fps:
+                self.next_frame_time = now
+            elif self.next_frame_time > now:
+                time.sleep(self.next_frame_time - now)
+            self.next_frame_time += 1.0 / self.native_fps
+
+        self.count_frame()
+        return True, frame
+
+    def release(self):
+        self.running = False
+        # Unblock the decoder if it's waiting for room
+        while not self.decoded.empty():
+            self.decoded.get_nowait()
+        self.decoder.join(1.0)
+        self.capture.release()
+
+
+class SyntheticSource(FrameSource):
+    """
+    Generates frames with a moving gradient for load tests, at `fps` or as fast as possible if that's None. Frames are
+    fresh arrays, like a camera's.
+    """
+
+    def __init__(self, width, height, fps=None):
+        super().__init__()
+        self.fps = fps
+        self.pattern = np.tile(np.arange(width + height, dtype=np.uint8)[np.newaxis, :, np.newaxis], (height, 1, 3))
+        self.width = width
+        self.next_frame_time = None
+
+    def read(self):
+        if self.fps:
+            now = time.monotonic()
+            if self.next_frame_time is not None and self.next_frame_time > now:
+                time.sleep(self.next_frame_time - now)
+            self.next_frame_time = max(self.next_frame_time or now, now - 1.0 / self.fps) + 1.0 / self.fps
+
+        offset = (self.frames * 4) % (self.pattern.shape[1] - self.width)
+        frame = self.pattern[:, offset:offset + self.width].copy()
+        self.count_frame()
+        return True, frame
+
+
+def create_frame_source(spec, width, height, fps=30, fourcc=CAMERA_FOURCC, real_time=True):
+    """
+    Opens a frame source from a spec: a camera id, "synthetic", or the path of a video file. Files are scaled to the
+    given size, synthetic frames are generated at `fps` unless `real_time` is off.
+    """
+    if isinstance(spec, int) or str(spec).isdigit():
+        return CameraSource(width, height, int(spec), fps, fourcc)
+    elif spec == "synthetic":
+        return SyntheticSource(width, height, fps if real_time else None)
+
+    return VideoFileSource(spec, (width, height), real_time)
+
+
+class FrameBuffer(object):
+    """
+    Fixed-size "latest frame wins" buffer between the capture thread and its consumers.
+
+    Holds at most `size` frames. Pushing into a full buffer evicts the oldest frame, and popping always hands out the
+    newest frame, discarding anything older. Frames that leave the buffer without ever being handed out are counted as
+    dropped, frames that are older than `max_age` seconds when popped are counted as stale and not handed out.
+    """
+
+    def __init__(self, size=FRAME_BUFFER_SIZE, max_age=MAX_FRAME_AGE):
+        self.frames = collections.deque(maxlen=size)
+        self.max_age = max_age
+        self.condition = threading.Condition()
+
+        self.seq = 0
+        self.captured = 0
+        self.dropped = 0
+        self.stale = 0
+
+    def push(self, image, timestamp=None, inference_image=None):
+        """
+        Stores a new frame, evicting the oldest one if the buffer is full. Returns the stored frame.
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        with self.condition:
+            self.seq += 1
+            self.captured += 1
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+
+            frame = CapturedFrame(self.seq, timestamp, image, inference_image)
+            self.frames.append(frame)
+            self.condition.notify_all()
+
+        return frame
+
+    def pop(self):
+        """
+        Returns the newest frame and empties the buffer, or None if there is no (fresh) frame available.
+        """
+        with self.condition:
+            return self._pop_newest()
+
+    def wait(self, timeout=None):
+        """
+        Like pop, but blocks up to `timeout` seconds for a frame to arrive.
+        """
+        with self.condition:
+            if not self.frames:
+                self.condition.wait(timeout)
+
+            return self._pop_newest()
+
+    def depth(self):
+        with self.condition:
+            return len(self.frames)
+
+    def _pop_newest(self):
+        if not self.frames:
+            return None
+
+        frame = self.frames.pop()
+        self.dropped += len(self.frames)
+        self.frames.clear()
+
+        if self.max_age is not None and time.monotonic() - frame.timestamp > self.max_age:
+            self.stale += 1
+            return None
+
+        return frame
+
+
 class FrameGrabber(threading.Thread):
     """
-    Grabs the camera by the frame.
+    Grabs the camera, or another frame source, by the frame.
+
+    If an inference size is given, every frame also gets a copy downscaled to that size for the pose estimator.
     """
 
-    def __init__(self, width, height, cam_id=0, fps=30):
+    def __init__(self, width, height, cam_id=0, fps=30, buffer_size=FRAME_BUFFER_SIZE, max_frame_age=MAX_FRAME_AGE,
+                 inference_size=None, source=None):
         super().__init__()
 
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.queue = queue.Queue()
-        self.camera = setup_camera_streaming(width, height, cam_id, fps)
+        self.size = (width, height)
+        self.inference_size = inference_size
+        self.buffer = FrameBuffer(buffer_size, max_frame_age)
+        self.source = source if source else CameraSource(width, height, cam_id, fps)
+        self.recorder = None
         self.running = True
 
+        registry.set_gauge("capture.queue_depth", self.buffer.depth)
+        registry.set_gauge("capture.captured", lambda: self.buffer.captured)
+        registry.set_gauge("capture.dropped", lambda: self.buffer.dropped)
+        registry.set_gauge("capture.stale", lambda: self.buffer.stale)
+        registry.set_gauge("capture.source_fps", self.source.throughput)
+
     def run(self):
         self.logger.info("Starting FrameGrabber")
 
         while self.running:
-            _, frame = self.camera.read()
-            flipped = cv2.flip(frame, 1)
-            self.queue.put(flipped)
+            with registry.timer("capture.read"):
+                success, frame = self.source.read()
+            if not success:
+                registry.increment("capture.failed_reads")
+                time.sleep(FAILED_READ_BACKOFF)
+                continue
 
-        self.camera.release()
+            timestamp = time.monotonic()
+            if (frame.shape[1], frame.shape[0]) != self.size:
+                frame = cv2.resize(frame, self.size)
+            with registry.timer("capture.flip"):
+                flipped = cv2.flip(frame, 1)
+
+            downscaled = None
+            if self.inference_size:
+                with registry.timer("capture.downscale"):
+                    downscaled = cv2.resize(flipped, self.inference_size, interpolation=cv2.INTER_AREA)
+
+            captured = self.buffer.push(flipped, timestamp, downscaled)
+            registry.trace(captured.seq, "capture", timestamp)
+            if self.recorder:
+                self.recorder.record_frame(captured)
+
+        self.source.release()
+        self.logger.info("Captured %d frames at %.1f fps, dropped %d, stale %d",
+                         self.buffer.captured, self.source.throughput(), self.buffer.dropped, self.buffer.stale)
 
     def stop(self):
         self.logger.info("Stopping FrameGrabber")
         self.running = False
 
     def pop_frame(self):
-        frame = None
-        if not self.queue.empty():
-            frame = self.queue.get_nowait()
-
-        return frame
+        """
+        Returns the newest CapturedFrame, or None if no new frame has been captured since the last call.
+        """
+        return self.buffer.pop()
 
+    def wait_for_frame(self, timeout=None):
+        return self.buffer.wait(timeout)
@@ -7,13 +7,79 @@ DT = 1.0 / 60.0
 DAMPING = 0.8
 
 MAX_DISTANCE_THRESHOLD = 75
-PHYSICS_STEPS_PER_FRAME = 1
+# Physics runs in fixed DT steps as wall time passes, with at most this many steps per rendered frame
+MAX_PHYSICS_STEPS_PER_FRAME = 5
+FRAME_RATE_CAP = 50
 
 PUSH_BODY_FRICTION = 0.9
 PUSH_BODY_ELASTICITY = 1.0
 PUSH_BODY_RADIUS = 50
 PUSH_BODY_MASS = 5
 PUSH_BODY_MAX_V = 50
+# Push bodies created up front, enough for a few players and the mouse
+PUSH_BODY_POOL_SIZE = 8
+
+# Crowd mode: the spatial hash cell size and buckets per push body, the distance from the logo beyond which push bodies
+# don't collide, and the number of colliding hands per vertical strip of the screen, nearest to the logo first
+CROWD_HASH_CELL_SIZE = 2 * PUSH_BODY_RADIUS
+CROWD_HASH_COUNT_PER_BODY = 10
+CROWD_CULL_DISTANCE = 400
+CROWD_REGIONS = 8
+CROWD_HANDS_PER_REGION = 4
+
+# Seconds a hand or a whole player may go undetected before it's removed from the game
+HAND_GRACE_PERIOD = 0.2
+PLAYER_GRACE_PERIOD = 0.5
+# Seconds the field stays empty after the last player is gone before the game is reset
+RESET_GRACE_PERIOD = 2.0
+
+# Capture buffer: number of frames kept and the age (in seconds) after which a frame is considered stale
+FRAME_BUFFER_SIZE = 1
+MAX_FRAME_AGE = 0.5
+
+# Camera codec and number of frames the driver may queue, and how many decoded frames a video file source reads ahead
+CAMERA_FOURCC = "MJPG"
+CAMERA_BUFFER_SIZE = 1
+VIDEO_DECODE_QUEUE_SIZE = 4
+# Seconds to wait after a failed read, so a camera that's gone or a file that ended doesn't keep a core busy
+FAILED_READ_BACKOFF = 0.01
+
+# Histograms keep this many recent samples, frames are traced from capture to display for this many sequence numbers
+METRICS_WINDOW = 1000
+MAX_TRACED_FRAMES = 256
+METRICS_INTERVAL = 5.0
+
+# Records the background log handler holds before it drops them, and the seconds between two debug messages with the
+# same text from a rate limited logger
+LOG_QUEUE_SIZE = 1024
+LOG_DEBUG_INTERVAL = 1.0
+
+# Adaptive inference: net resolutions to choose from, best first, and the inference latency to stay within. The
+# latency is smoothed with INFERENCE_LATENCY_SMOOTHING, and the resolution changes at most once per
+# INFERENCE_SWITCH_COOLDOWN seconds. Without players for IDLE_AFTER seconds, inference only runs every IDLE_INTERVAL
+INFERENCE_NET_RESOLUTIONS = ("-1x368", "-1x256", "-1x176")
+INFERENCE_LATENCY_BUDGET = 0.1
+INFERENCE_LATENCY_SMOOTHING = 0.2
+INFERENCE_SWITCH_COOLDOWN = 1.0
+IDLE_AFTER = 2.0
+IDLE_INTERVAL = 0.5
+
+# Slots per shared memory ring in the multi-process pipeline, the most poses a result can hold, and how often an idle
+# reader checks for a new record
+SHARED_RING_SLOTS = 3
+MAX_SHARED_POSES = 16
+RING_POLL_INTERVAL = 0.001
+
+# Inference pool: a result that's next in frame order is waited for this many seconds at most, while newer ones are in
+INFERENCE_POOL_MAX_WAIT = 0.2
+# Seconds the game waits for the pose model to load, in the inference pool or when quitting, before giving up
+MODEL_LOAD_TIMEOUT = 120.0
+
+# Region of interest around the previous skeletons, as a fraction of their size. The full frame is searched every
+# ROI_FULL_FRAME_INTERVAL frames, or when the region would cover more than ROI_MAX_AREA_FRACTION of it
+ROI_MARGIN = 0.3
+ROI_FULL_FRAME_INTERVAL = 10
+ROI_MAX_AREA_FRACTION = 0.8
 
 COUNTER_MARGIN = 20
 GOAL_FRICTION = 0.9
@@ -26,21 +92,50 @@ LOGO_MASS = 5
 LOGO_FRICTION = 0.95
 LOGO_ELASTICITY = 1.0
 LOGO_SIZE = (120, 120)
+# Rotated logos are cached per this many degrees, up to the given number of images
+LOGO_ROTATION_RESOLUTION = 1.0
+LOGO_ROTATION_CACHE_SIZE = 360
 
 COLLTYPE_MOUSE = 1
 COLLTYPE_LOGO = 2
 COLLTYPE_GOAL = 3
 
 # Taken from: https://github.com/CMU-Perceptual-Computing-Lab/openpose/blob/master/doc/output.md
-LEFT_WRIST_IDX = 7
-LEFT_ELBOW_IDX = 6
-RIGHT_WRIST_IDX = 4
+NUM_KEY_POINTS = 25
+NOSE_IDX = 0
+NECK_IDX = 1
+RIGHT_SHOULDER_IDX = 2
 RIGHT_ELBOW_IDX = 3
-NECK_IDX = 2
+RIGHT_WRIST_IDX = 4
+LEFT_SHOULDER_IDX = 5
+LEFT_ELBOW_IDX = 6
+LEFT_WRIST_IDX = 7
+MID_HIP_IDX = 8
+
+# Torso key points used to match poses to players, these move the least while slapping
+TRACKING_KEY_POINTS = [NECK_IDX, RIGHT_SHOULDER_IDX, LEFT_SHOULDER_IDX, MID_HIP_IDX]
+
+# Arm key points are smoothed with a One Euro filter (cutoffs in Hz, beta per pixel/s) and predicted forward in time
+# to make up for the inference latency, by at most MAX_PREDICTION_LEAD seconds
+FILTERED_KEY_POINTS = [RIGHT_ELBOW_IDX, RIGHT_WRIST_IDX, LEFT_ELBOW_IDX, LEFT_WRIST_IDX]
+FILTER_MIN_CUTOFF = 1.0
+FILTER_BETA = 0.01
+FILTER_DERIVATIVE_CUTOFF = 1.0
+MAX_PREDICTION_LEAD = 0.25
 
 # Lol, this is actually the golden ratio, look it up
 HAND_FOREARM_RATIO = (1 + 5 ** 0.5) / 2
 
 FONT_NAME = 'Comic Sans MS'  # Hell yeah
 FONT_SIZE = 60
-OBJECT_COLOR = (229, 11, 20)
\ No newline at end of file
+OBJECT_COLOR = (229, 11, 20)
+
+# How the rendered frame is scaled to a display of another size: "scaled" lets SDL scale it (pygame 2), "smooth"
+# scales it in software with smoothscale
+DISPLAY_SCALING = "scaled"
+
+# Skeletons drawn by the game instead of OpenPose, and the markers on the hands
+SKELETON_LINE_WIDTH = 4
+SKELETON_JOINT_RADIUS = 4
+HAND_MARKER_COLOR = (255, 255, 255)
+HAND_MARKER_WIDTH = 3
\ No newline at end of file
@@ -0,0 +1,256 @@
+"""
+Getting camera frames onto the screen.
+
+@author: Jeroen Vlek <j.vlek@anchormen.nl>
+"""
+
+import logging
+import math
+import sys
+
+import cv2
+import numpy as np
+import pygame
+
+from constants import *
+
+# Channel masks of a surface that stores its pixels as B, G, R(, X) bytes on a little endian machine
+BGR_MASKS = (0xFF0000, 0x00FF00, 0x0000FF)
+
+# Limbs of the BODY_25 skeleton, per colour: head, torso, right arm, left arm, right leg, left leg
+BODY_25_LIMBS = [((255, 0, 170), [(1, 0), (0, 15), (15, 17), (0, 16), (16, 18)]),
+                 ((255, 0, 0), [(1, 8), (1, 2), (1, 5)]),
+                 ((255, 170, 0), [(2, 3), (3, 4)]),
+                 ((170, 255, 0), [(5, 6), (6, 7)]),
+                 ((0, 255, 170), [(8, 9), (9, 10), (10, 11), (11, 22), (22, 23), (11, 24)]),
+                 ((0, 170, 255), [(8, 12), (12, 13), (13, 14), (14, 19), (19, 20), (14, 21)])]
+
+
+def pixel_array(surface):
+    """
+    Returns a height x width x bytes per pixel array that shares its memory with the surface. The surface stays locked
+    for as long as the array exists.
+    """
+    width, height = surface.get_size()
+    raw = np.frombuffer(surface.get_buffer(), dtype=np.uint8)
+    return np.lib.stride_tricks.as_strided(raw, (height, width, surface.get_bytesize()),
+                                           (surface.get_pitch(), surface.get_bytesize(), 1))
+
+
+def has_bgr_layout(surface):
+    return sys.byteorder == 'little' and tuple(surface.get_masks()[0:3]) == BGR_MASKS
+
+
+class FramePresenter(object):
+    """
+    Draws BGR frames onto a target surface in a single pass, without allocating any frame sized buffers.
+
+    If the target stores its pixels as B, G, R, X bytes, which is the usual 32 bit layout, frames are converted straight
+    into its pixels. Otherwise they're copied into a persistent 24 bit surface whose masks match BGR, and blitted from
+    there.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.frame_surface = None
+
+    def present(self, frame):
+        height, width = frame.shape[0:2]
+        if (width, height) == self.target.get_size() and self.target.get_bytesize() == 4 and \
+                has_bgr_layout(self.target):
+            pixels = pixel_array(self.target)
+            cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA, dst=pixels)
+            del pixels
+            return
+
+        if self.frame_surface is None or self.frame_surface.get_size() != (width, height):
+            self.frame_surface = pygame.Surface((width, height), 0, 24, BGR_MASKS + (0,))
+
+        pixels = pixel_array(self.frame_surface)
+        np.copyto(pixels, frame, casting='unsafe')
+        del pixels
+        self.target.blit(self.frame_surface, (0, 0))
+
+
+class StaticLayer(object):
+    """
+    The goals and score counters, pre-rendered onto a transparent layer and onto a plain background.
+
+    Both are only re-rendered when a score changes. Drawing the layer onto a frame only touches the areas the static
+    elements cover.
+    """
+
+    def __init__(self, size, background_color, line_color=OBJECT_COLOR, line_width=GOAL_MARGIN):
+        self.layer = pygame.Surface(size, pygame.SRCALPHA)
+        self.background = pygame.Surface(size)
+        self.background_color = background_color
+        self.line_color = line_color
+        self.line_width = line_width
+        self.rects = []
+        self.rendered_state = None
+
+    def update(self, goals):
+        """
+        Re-renders the layer if any of the goals' scores changed since the last time. Returns whether it did.
+        """
+        state = tuple(goal.counter.score for goal in goals)
+        if state == self.rendered_state:
+            return False
+
+        self.layer.fill((0, 0, 0, 0))
+        self.rects = []
+        for goal in goals:
+            self.rects.append(pygame.draw.line(self.layer, self.line_color, goal.a, goal.b, self.line_width))
+            self.rects.append(self.layer.blit(goal.counter.text, goal.counter.pos))
+
+        self.background.fill(self.background_color)
+        self.background.blit(self.layer, (0, 0))
+        self.rendered_state = state
+        return True
+
+    def draw(self, surface):
+        for rect in self.rects:
+            surface.blit(self.layer, rect, rect)
+
+
+class SkeletonOverlay(object):
+    """
+    Draws skeletons straight from the key points, so the pose backend doesn't have to render a whole frame for them.
+
+    The limbs found in all poses are selected in one go, and drawn per colour.
+    """
+
+    def __init__(self, limbs=BODY_25_LIMBS, line_width=SKELETON_LINE_WIDTH, joint_radius=SKELETON_JOINT_RADIUS,
+                 hand_color=HAND_MARKER_COLOR, hand_width=HAND_MARKER_WIDTH, hand_radius=PUSH_BODY_RADIUS):
+        self.groups = [(color, np.array(pairs)) for color, pairs in limbs]
+        self.line_width = line_width
+        self.joint_radius = joint_radius
+        self.hand_color = hand_color
+        self.hand_width = hand_width
+        self.hand_radius = hand_radius
+
+    def draw(self, surface, poses, hands=()):
+        """
+        Draws the N x 25 x 3 poses and a circle around every hand position. Returns the rects drawn on.
+        """
+        rects = []
+        poses = np.asarray(poses)
+        if len(poses):
+            points = poses[:, :, 0:2].astype(int).tolist()
+            found = poses[:, :, 2] > 0
+            for color, pairs in self.groups:
+                visible = found[:, pairs[:, 0]] & found[:, pairs[:, 1]]
+                for pose_idx, limb_idx in zip(*np.nonzero(visible)):
+                    start, end = pairs[limb_idx]
+                    pose = points[pose_idx]
+                    rects.append(pygame.draw.line(surface, color, pose[start], pose[end], self.line_width))
+                    rects.append(pygame.draw.circle(surface, color, pose[end], self.joint_radius))
+
+        for hand in hands:
+            rects.append(pygame.draw.circle(surface, self.hand_color, (int(hand[0]), int(hand[1])), self.hand_radius,
+                                            self.hand_width))
+
+        return rects
+
+
+class ScaledDisplay(object):
+    """
+    The display, with a render surface of `size` that's scaled to the window or screen when that's a different size.
+
+    Everything is rendered at `size`, so the cost of a frame doesn't depend on the size of the physical screen. With
+    `scaling` "scaled", SDL scales the render surface when a `display_size` is given or in fullscreen: it sizes the
+    window itself, to fit the desktop, and in fullscreen it fills the screen. With "smooth", the display is
+    `display_size` and the render surface is a separate surface that's smoothscaled into it, only the dirty areas if
+    possible.
+    """
+
+    def __init__(self, size, display_size=None, scaling=DISPLAY_SCALING):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.size = tuple(size)
+        self.display_size = tuple(display_size) if display_size else self.size
+        self.scaling = scaling
+        if scaling == "scaled" and self.display_size != self.size:
+            if hasattr(pygame, "SCALED"):
+                self.logger.info("SDL sizes the scaled window itself, the display size only applies to smooth scaling")
+            else:
+                self.logger.warning("This pygame can't scale the display, scaling in software instead")
+                self.scaling = "smooth"
+
+        self.display = None
+        self.surface = None
+        self.set_mode()
+
+    @property
+    def software_scaling(self):
+        return self.display_size != self.size and self.scaling == "smooth"
+
+    def set_mode(self, flags=0):
+        """
+        (Re)creates the display with the given flags, returns the surface to render to
+        """
+        sdl_scaling = self.scaling == "scaled" and hasattr(pygame, "SCALED") and \
+            (self.display_size != self.size or flags & pygame.FULLSCREEN)
+        if self.software_scaling:
+            self.display = pygame.display.set_mode(self.display_size, flags)
+            if self.surface is None:
+                # In the display's pixel format, so frames and blits are converted once
+                self.surface = pygame.Surface(self.size)
+        elif sdl_scaling:
+            self.display = self.surface = pygame.display.set_mode(self.size, flags | pygame.SCALED)
+        else:
+            self.display = self.surface = pygame.display.set_mode(self.size, flags)
+
+        if sdl_scaling:
+            self.logger.info("Rendering at %dx%d, scaled by SDL", *self.size)
+        else:
+            self.logger.info("Rendering at %dx%d, displaying at %dx%d", self.size[0], self.size[1],
+                             *self.display.get_size())
+        return self.surface
+
+    def to_surface(self, pos):
+        """
+        Maps a position on the display, like that of the mouse, to the render surface
+        """
+        if not self.software_scaling:
+            return pos
+
+        return (pos[0] * self.size[0] / float(self.display_size[0]),
+                pos[1] * self.size[1] / float(self.display_size[1]))
+
+    def scaled_rect(self, rect):
+        """
+        The area of the display that shows `rect` of the render surface, in whole pixels
+        """
+        scale_x = self.display_size[0] / float(self.size[0])
+        scale_y = self.display_size[1] / float(self.size[1])
+        left, top = int(rect.left * scale_x), int(rect.top * scale_y)
+        right = min(int(math.ceil(rect.right * scale_x)), self.display_size[0])
+        bottom = min(int(math.ceil(rect.bottom * scale_y)), self.display_size[1])
+        return pygame.Rect(left, top, right - left, bottom - top)
+
+    def update(self, rects=None):
+        """
+        Shows the render surface, or only the given areas of it
+        """
+        if not self.software_scaling:
+            if rects is None:
+                pygame.display.flip()
+            else:
+                pygame.display.update(rects)
+            return
+
+        if rects is None:
+            pygame.transform.smoothscale(self.surface, self.display_size, self.display)
+            pygame.display.flip()
+            return
+
+        bounds = self.surface.get_rect()
+        scaled_rects = []
+        for rect in rects:
+            rect = rect.clip(bounds)
+            scaled = self.scaled_rect(rect)
+            if rect.width and rect.height and scaled.width and scaled.height:
+                pygame.transform.smoothscale(self.surface.subsurface(rect), scaled.size,
+                                             self.display.subsurface(scaled))
+                scaled_rects.append(scaled)
+        pygame.display.update(scaled_rects)
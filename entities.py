@@ -3,36 +3,55 @@ All objects present in the game, including the players.
 
 @author: Jeroen Vlek <j.vlek@anchormen.nl>
 """
+import collections
 import math
 
 import numpy as np
 import pygame
 import pymunk
 
+from assets import load_font, load_image
 from constants import *
 
-pygame.font.init()
 
+class Score(object):
+    """
+    Goals scored by one side, without anything to show for it
+    """
 
-class ScoreCounter(object):
-    font = pygame.font.SysFont(FONT_NAME, FONT_SIZE)
-
-    def __init__(self, pos):
-        self.pos = pos
+    def __init__(self):
         self.score = 0
-        self.text = ScoreCounter.font.render(str(self.score), False, OBJECT_COLOR)
 
     def reset(self):
         self.set_score(0)
 
     def set_score(self, score):
         self.score = score
-        self.text = ScoreCounter.font.render(str(self.score), False, OBJECT_COLOR)
 
     def add_goal(self):
         self.set_score(self.score + 1)
 
 
+class ScoreCounter(Score):
+
+    def __init__(self, pos):
+        self.pos = pos
+        # Rendered scores, so going back to 0 on a reset doesn't render anything
+        self.texts = {}
+        super().__init__()
+        self.text = self.render(self.score)
+
+    def render(self, score):
+        text = self.texts.get(score)
+        if text is None:
+            text = self.texts[score] = load_font(FONT_NAME, FONT_SIZE).render(str(score), False, OBJECT_COLOR)
+        return text
+
+    def set_score(self, score):
+        self.score = score
+        self.text = self.render(score)
+
+
 class GoalPost(pymunk.Segment):
 
     def __init__(self, body, first_pos, second_pos, radius, counter):
@@ -57,12 +76,16 @@ class PushBody(object):
     Used to push the logo, either via mouse or through pose skeletons
     """
 
-    def __init__(self, pos):
+    def __init__(self, pos, limit_per_step=True):
         inertia = pymunk.moment_for_circle(PUSH_BODY_MASS, 0, PUSH_BODY_RADIUS, (0, 0))
 
         self.body = pymunk.Body(PUSH_BODY_MASS, inertia, pymunk.Body.KINEMATIC)
         self.body.position = pos
-        self.body.velocity_func = PushBody.limit_velocity
+        # The velocity callback costs a call into Python per body per step, which adds up with a crowd. Nothing else
+        # changes the velocity of a kinematic body, so it may as well be limited when it's set.
+        self.limit_per_step = limit_per_step
+        if limit_per_step:
+            self.body.velocity_func = PushBody.limit_velocity
 
         self.shape = pymunk.Circle(self.body, PUSH_BODY_RADIUS, (0, 0))
         self.shape.collision_type = COLLTYPE_MOUSE
@@ -74,10 +97,12 @@ class PushBody(object):
         Moves PushBody to new position and calculates new velocity
         """
         old_pos = self.body.position
-        new_v = (new_pos - old_pos) / dt
-        interpolated_v = (new_v + self.body.velocity) / 2
         # self.body.position = new_pos
-        self.body.velocity = interpolated_v
+        self.body.velocity = (new_pos - old_pos) / dt
+        if not self.limit_per_step:
+            length = self.body.velocity.length
+            if length > PUSH_BODY_MAX_V:
+                self.body.velocity = self.body.velocity * (PUSH_BODY_MAX_V / length)
 
     @staticmethod
     def limit_velocity(body, gravity, damping, dt):
@@ -88,82 +113,279 @@ class PushBody(object):
             body.velocity = body.velocity * scale
 
 
-class Player(object):
+class PushBodyPool(object):
+    """
+    Push bodies that stay in the space for good, so hands coming and going don't rebuild the space.
 
-    def __init__(self, space):
-        self.space = space
-        self.right_hand = None
-        self.left_hand = None
-        self.key_points = None
+    Bodies that aren't in use are parked: out of sight, standing still and filtered out of all collisions. The pool
+    grows when it runs out. With `limit_per_step` off, the bodies' velocities are limited when they move instead of in
+    every physics step.
+    """
+
+    parked = pymunk.ShapeFilter(categories=0, mask=0)
+    parking_position = pymunk.Vec2d(-10 * PUSH_BODY_RADIUS, -10 * PUSH_BODY_RADIUS)
 
-    def distance(self, other_key_points):
+    def __init__(self, space, size=PUSH_BODY_POOL_SIZE, limit_per_step=True):
+        self.space = space
+        self.limit_per_step = limit_per_step
+        self.free = []
+        self.in_use = []
+        for _ in range(size):
+            self.free.append(self.create())
+
+    def create(self):
+        push_body = PushBody(PushBodyPool.parking_position, self.limit_per_step)
+        self.park(push_body)
+        self.space.add(push_body.body, push_body.shape)
+        return push_body
+
+    def park(self, push_body):
+        push_body.shape.filter = PushBodyPool.parked
+        push_body.body.velocity = (0, 0)
+        push_body.body.position = PushBodyPool.parking_position
+
+    def acquire(self, pos):
         """
-        Compute summed distance to other key points
+        Returns an active push body at the given position
         """
-        distance = math.inf
-        if other_key_points[NECK_IDX][2] > 0:
-            neck_pos = np.array(self.key_points[NECK_IDX][0:1])
-            other_neck_pos = np.array(other_key_points[NECK_IDX][0:1])
-            distance = np.linalg.norm(neck_pos - other_neck_pos)
+        push_body = self.free.pop() if self.free else self.create()
+        push_body.body.position = pos
+        push_body.shape.filter = pymunk.ShapeFilter()
+        self.space.reindex_shapes_for_body(push_body.body)
+        self.in_use.append(push_body)
+        return push_body
 
-        return distance
+    def release(self, push_body):
+        self.park(push_body)
+        self.in_use.remove(push_body)
+        self.free.append(push_body)
 
-    def update_pose(self, new_key_points, dt):
 
-        right_hand_pos = Player.extrapolate_hand_position(new_key_points, RIGHT_WRIST_IDX, RIGHT_ELBOW_IDX)
-        if right_hand_pos is not None:
+class PlayerStore(object):
+    """
+    The state of all players, in arrays with a row per player: their key points with confidences, track ids, when
+    they were last seen, and their hands with how long each has been missing.
 
-            if self.right_hand:
-                self.right_hand.move(right_hand_pos, dt)
-            else:
-                self.right_hand = PushBody(right_hand_pos)
-                self.space.add(self.right_hand.body, self.right_hand.shape)
-        else:
-            # No right hand found. Removing PushObject if it exists
-            self.remove_right_hand()
-
-        left_hand_pos = Player.extrapolate_hand_position(new_key_points, LEFT_WRIST_IDX, LEFT_ELBOW_IDX)
-        if left_hand_pos is not None:
-            if self.left_hand:
-                self.left_hand.move(left_hand_pos, dt)
-            else:
-                self.left_hand = PushBody(left_hand_pos)
-                self.space.add(self.left_hand.body, self.left_hand.shape)
-        else:
-            # No left hand found. Removing PushObject if it exists
-            self.remove_left_hand()
+    The hands of all players are extrapolated from their forearms in one go, only writing to the physics bodies is
+    done one body at a time. A hand that goes missing stands still for up to `hand_grace_period` seconds before it's
+    retired, so a single missed detection doesn't drop it. Rows are reused, and the arrays double when they run out.
+    """
 
-        self.key_points = new_key_points
+    # Wrist and elbow of the right and the left hand
+    wrist_ids = [RIGHT_WRIST_IDX, LEFT_WRIST_IDX]
+    elbow_ids = [RIGHT_ELBOW_IDX, LEFT_ELBOW_IDX]
+
+    def __init__(self, pool, hand_grace_period=HAND_GRACE_PERIOD, capacity=8):
+        self.pool = pool
+        self.hand_grace_period = hand_grace_period
+        self.key_points = np.zeros((capacity, NUM_KEY_POINTS, 3), dtype=np.float32)
+        self.has_key_points = np.zeros(capacity, dtype=bool)
+        self.track_ids = np.zeros(capacity, dtype=np.int64)
+        self.last_seen = np.zeros(capacity)
+        self.visible = np.zeros(capacity, dtype=bool)
+        self.hands = np.full((capacity, 2), None, dtype=object)
+        self.hand_missing = np.zeros((capacity, 2))
+        self.free_rows = list(range(capacity - 1, -1, -1))
+
+    def _grow(self):
+        capacity = len(self.track_ids)
+        for name in ("key_points", "has_key_points", "track_ids", "last_seen", "visible", "hands", "hand_missing"):
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+        self.hands[capacity:] = None
+        self.free_rows = list(range(2 * capacity - 1, capacity - 1, -1))
+
+    def add(self, track_id):
+        """
+        Returns a new, visible player without key points or hands yet
+        """
+        if not self.free_rows:
+            self._grow()
+
+        row = self.free_rows.pop()
+        self.track_ids[row] = track_id
+        self.has_key_points[row] = False
+        self.visible[row] = True
+        self.last_seen[row] = 0.0
+        self.hand_missing[row] = 0.0
+        return Player(self, row)
+
+    def remove(self, player):
+        """
+        Releases the player's hands and its row
+        """
+        row = player.row
+        for hand in self.hands[row]:
+            if hand:
+                self.pool.release(hand)
+        self.hands[row] = None
+        self.free_rows.append(row)
+
+    def set_poses(self, players, key_points, timestamp):
+        """
+        Stores the key points the players were seen with at `timestamp`. Their hands follow in update_poses.
+        """
+        rows = Player.rows(players)
+        self.key_points[rows] = key_points
+        self.has_key_points[rows] = True
+        self.last_seen[rows] = timestamp
+        self.visible[rows] = True
+
+    def update_poses(self, players, key_points, dt):
+        """
+        Stores the players' new key points (N x 25 x 3) and moves their hands towards them, to arrive `dt` seconds
+        from now
+        """
+        rows = Player.rows(players)
+        key_points = np.asarray(key_points, dtype=np.float32)
+        wrists = key_points[:, self.wrist_ids]
+        elbows = key_points[:, self.elbow_ids]
+        found = (wrists[:, :, 2] > 0) & (elbows[:, :, 2] > 0)
+
+        # Whole pixels, like the positions the hands have always been placed at
+        elbow_positions = np.trunc(elbows[:, :, 0:2]).astype(np.float64)
+        forearms = np.trunc(wrists[:, :, 0:2]) - elbow_positions
+        # The middle of the hand is a part of the forearm's length beyond the wrist
+        hand_positions = elbow_positions + (forearms + 0.25 * HAND_FOREARM_RATIO * forearms)
+
+        self._update_hands(rows, found, hand_positions, dt)
+        self.key_points[rows] = key_points
+        self.has_key_points[rows] = True
+
+    def hold(self, players, dt):
+        """
+        Lets the hands stand still while their players aren't detected, retiring them when their grace period runs out
+        """
+        rows = Player.rows(players)
+        self._update_hands(rows, np.zeros((len(rows), 2), dtype=bool), np.zeros((len(rows), 2, 2)), dt)
+
+    def _update_hands(self, rows, found, positions, dt):
+        hands = self.hands[rows]
+        exists = hands != None
+        missing = self.hand_missing[rows]
+
+        # Hands that are being followed get the velocity to arrive at their new position
+        moving = found & exists & (missing == 0)
+        if moving.any():
+            bodies = [hand.body for hand in hands[moving]]
+            current = np.array([tuple(body.position) for body in bodies])
+            velocities = (positions[moving] - current) / dt
+            if not self.pool.limit_per_step:
+                speeds = np.hypot(velocities[:, 0], velocities[:, 1])
+                velocities *= np.minimum(1.0, PUSH_BODY_MAX_V / np.maximum(speeds, 1e-9))[:, np.newaxis]
+            for body, velocity in zip(bodies, velocities.tolist()):
+                body.velocity = velocity
+
+        # Hands that have been standing still catch up in one go, instead of sweeping across the screen
+        for row_idx, side in zip(*np.nonzero(found & exists & (missing > 0))):
+            body = hands[row_idx, side].body
+            body.position = tuple(positions[row_idx, side])
+            self.pool.space.reindex_shapes_for_body(body)
+            self.hand_missing[rows[row_idx], side] = 0.0
+
+        for row_idx, side in zip(*np.nonzero(found & ~exists)):
+            self.hands[rows[row_idx], side] = self.pool.acquire(tuple(positions[row_idx, side]))
+            self.hand_missing[rows[row_idx], side] = 0.0
+
+        for row_idx, side in zip(*np.nonzero(~found & exists)):
+            row = rows[row_idx]
+            hand = hands[row_idx, side]
+            hand.body.velocity = (0, 0)
+            self.hand_missing[row, side] += dt
+            if self.hand_missing[row, side] > self.hand_grace_period:
+                self.pool.release(hand)
+                self.hands[row, side] = None
+                self.hand_missing[row, side] = 0.0
+
+
+class Player(object):
+    """
+    A tracked skeleton: a handle on its row of a PlayerStore
+    """
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
 
     @staticmethod
-    def extrapolate_hand_position(key_points, wrist_id, elbow_id):
-        if key_points[wrist_id][2] <= 0 or key_points[elbow_id][2] <= 0:
-            return None
+    def rows(players):
+        return np.array([player.row for player in players], dtype=np.int64)
 
-        wrist_pos = pymunk.Vec2d(int(key_points[wrist_id][0]), int(key_points[wrist_id][1]))
-        elbow_pos = pymunk.Vec2d(int(key_points[elbow_id][0]), int(key_points[elbow_id][1]))
+    @property
+    def track_id(self):
+        return int(self.store.track_ids[self.row])
 
-        forearm_vec = wrist_pos - elbow_pos  # went with vec instead of pos, because it's a direction
+    @property
+    def key_points(self):
+        return self.store.key_points[self.row] if self.store.has_key_points[self.row] else None
 
-        # the 0.5 is to make sure it's the middle of the hand
-        hand_vec = forearm_vec + 0.25 * HAND_FOREARM_RATIO * forearm_vec
-        hand_pos = elbow_pos + hand_vec
+    @property
+    def last_seen(self):
+        """
+        Timestamp of the last frame the player was detected in
+        """
+        return float(self.store.last_seen[self.row])
 
-        return hand_pos
+    @property
+    def visible(self):
+        return bool(self.store.visible[self.row])
 
-    def remove_left_hand(self):
-        if self.left_hand:
-            self.space.remove(self.left_hand.shape, self.left_hand.body)
-            self.left_hand = None
+    @visible.setter
+    def visible(self, visible):
+        self.store.visible[self.row] = visible
 
-    def remove_right_hand(self):
-        if self.right_hand:
-            self.space.remove(self.right_hand.shape, self.right_hand.body)
-            self.right_hand = None
+    @property
+    def right_hand(self):
+        return self.store.hands[self.row, 0]
+
+    @property
+    def left_hand(self):
+        return self.store.hands[self.row, 1]
 
     def destroy(self):
-        self.remove_left_hand()
-        self.remove_right_hand()
+        self.store.remove(self)
+
+
+class RotationCache(object):
+    """
+    Rotated versions of an image, keyed by the angle quantized to `resolution` degrees.
+
+    Holds at most `max_size` images, evicting the least recently used one.
+    """
+
+    def __init__(self, image, resolution=LOGO_ROTATION_RESOLUTION, max_size=LOGO_ROTATION_CACHE_SIZE):
+        self.image = image
+        self.resolution = resolution
+        self.steps = int(round(360.0 / resolution))
+        self.max_size = max_size
+        self.images = collections.OrderedDict()
+
+    def get(self, angle):
+        """
+        Returns the image rotated counter clockwise by (about) `angle` degrees
+        """
+        key = int(round(angle / self.resolution)) % self.steps
+        rotated = self.images.get(key)
+        if rotated is None:
+            rotated = pygame.transform.rotate(self.image, key * self.resolution)
+            if pygame.display.get_surface() is not None:
+                # Blitting is a lot cheaper in the display's pixel format
+                rotated = rotated.convert_alpha()
+
+            self.images[key] = rotated
+            if len(self.images) > self.max_size:
+                self.images.popitem(last=False)
+        else:
+            self.images.move_to_end(key)
+
+        return rotated
+
+    def prewarm(self):
+        """
+        Renders every rotation up front, as far as the cache size allows
+        """
+        for key in range(min(self.steps, self.max_size)):
+            self.get(key * self.resolution)
 
 
 class Logo(pygame.sprite.Sprite):
@@ -171,15 +393,38 @@ class Logo(pygame.sprite.Sprite):
     The logo or "ball" with which to be scored
     """
 
-    def __init__(self, spawn_point, image_path, logo_size=LOGO_SIZE):
-        raw_image = pygame.image.load(image_path)
-        self.image = self.original_image = pygame.transform.scale(raw_image, logo_size)
+    def __init__(self, spawn_point, image_path, logo_size=LOGO_SIZE, rotations=None, box=None):
+        self.image = self.original_image = load_image(image_path, logo_size)
         self.rect = self.image.get_rect(center=spawn_point)
-        self.box = Logo.create_logo_box(self.rect)
+        self.box = box if box else Logo.create_logo_box(self.rect)
+        self.rotations = rotations if rotations else RotationCache(self.original_image)
+        self.store_state()
+
+    def reset(self):
+        """
+        Catches up with the box after it was moved in place, without interpolating from where it was
+        """
+        self.store_state()
+        self.update()
+
+    def store_state(self):
+        """
+        Remembers the current physics state, call before every physics step to be able to interpolate
+        """
+        self.previous_position = self.box.body.position
+        self.previous_angle = self.box.body.angle
+
+    def update(self, alpha=1.0):
+        """
+        Updates image and rect to the physics state `alpha` of the way from the previous step to the current one
+        """
+        body = self.box.body
+        angle = self.previous_angle + (body.angle - self.previous_angle) * alpha
+        position = self.previous_position.interpolate_to(body.position, alpha)
 
-    def update(self):
-        self.image = pygame.transform.rotate(self.original_image, math.degrees(-self.box.body.angle))
-        self.rect = self.image.get_rect(center=self.box.body.position)
+        self.image = self.rotations.get(math.degrees(-angle))
+        self.rect.size = self.image.get_size()
+        self.rect.center = position
 
     @staticmethod
     def create_logo_box(rect):
@@ -0,0 +1,124 @@
+"""
+Smoothing and latency compensation of key point tracks.
+
+@author: Jeroen Vlek <j.vlek@anchormen.nl>
+"""
+
+import math
+
+import numpy as np
+
+from constants import *
+
+
+def smoothing_factor(dt, cutoff):
+    """
+    Exponential smoothing factor of a low pass filter with the given cutoff frequency, for samples dt seconds apart
+    """
+    tau = 1.0 / (2 * math.pi * cutoff)
+    return 1.0 / (1.0 + tau / dt)
+
+
+class KeypointFilter(object):
+    """
+    One Euro filter over selected key points of all tracks at once, with a constant velocity prediction on top.
+
+    The One Euro filter smooths heavily while a key point is (nearly) still and lets it follow quickly when it moves
+    fast, see http://cristal.univ-lille.fr/~casiez/1euro/. The velocity it estimates on the way is used to predict key
+    points forward in time, to make up for the inference latency. State is kept in arrays with a row per track.
+    """
+
+    def __init__(self, key_point_ids=FILTERED_KEY_POINTS, min_cutoff=FILTER_MIN_CUTOFF, beta=FILTER_BETA,
+                 derivative_cutoff=FILTER_DERIVATIVE_CUTOFF, max_lead=MAX_PREDICTION_LEAD):
+        self.key_point_ids = key_point_ids
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.derivative_cutoff = derivative_cutoff
+        self.max_lead = max_lead
+
+        self.rows = {}
+        self.free_rows = []
+        num_key_points = len(key_point_ids)
+        self.positions = np.zeros((0, num_key_points, 2))
+        self.velocities = np.zeros((0, num_key_points, 2))
+        self.found = np.zeros((0, num_key_points), dtype=bool)
+        self.timestamps = np.zeros(0)
+        self.key_points = np.zeros((0, NUM_KEY_POINTS, 3), dtype=np.float32)
+
+    def _rows_for(self, track_ids):
+        rows = np.empty(len(track_ids), dtype=np.int64)
+        new = np.zeros(len(track_ids), dtype=bool)
+        for i, track_id in enumerate(track_ids):
+            row = self.rows.get(track_id)
+            if row is None:
+                row = self.free_rows.pop() if self.free_rows else self._grow()
+                self.rows[track_id] = row
+                new[i] = True
+            rows[i] = row
+
+        return rows, new
+
+    def _grow(self):
+        row = len(self.timestamps)
+        self.positions = np.concatenate([self.positions, np.zeros((1,) + self.positions.shape[1:])])
+        self.velocities = np.concatenate([self.velocities, np.zeros((1,) + self.velocities.shape[1:])])
+        self.found = np.concatenate([self.found, np.zeros((1,) + self.found.shape[1:], dtype=bool)])
+        self.timestamps = np.concatenate([self.timestamps, np.zeros(1)])
+        self.key_points = np.concatenate([self.key_points, np.zeros((1,) + self.key_points.shape[1:],
+                                                                    dtype=np.float32)])
+        return row
+
+    def update(self, track_ids, key_points, timestamp):
+        """
+        Feeds the key points (N x 25 x 3) detected for the given tracks in a frame captured at `timestamp`, and
+        returns a filtered copy
+        """
+        key_points = np.array(key_points, dtype=np.float32)
+        if len(track_ids) == 0:
+            return key_points
+
+        rows, new = self._rows_for(track_ids)
+        raw = key_points[:, self.key_point_ids, 0:2].astype(np.float64)
+        found = key_points[:, self.key_point_ids, 2] > 0
+
+        previous = self.positions[rows]
+        previous_velocity = self.velocities[rows]
+        dt = np.maximum(timestamp - self.timestamps[rows], 1e-3)[:, np.newaxis, np.newaxis]
+
+        # Key points that weren't around in the previous frame start over from the raw detection
+        restart = new[:, np.newaxis] | ~self.found[rows] | ~found
+
+        velocity = previous_velocity + smoothing_factor(dt, self.derivative_cutoff) * \
+            ((raw - previous) / dt - previous_velocity)
+        speed = np.linalg.norm(velocity, axis=-1, keepdims=True)
+        alpha = smoothing_factor(dt, self.min_cutoff + self.beta * speed)
+        position = previous + alpha * (raw - previous)
+
+        position = np.where(restart[..., np.newaxis], raw, position)
+        velocity = np.where(restart[..., np.newaxis], 0, velocity)
+
+        self.positions[rows] = position
+        self.velocities[rows] = velocity
+        self.found[rows] = found
+        self.timestamps[rows] = timestamp
+
+        key_points[:, self.key_point_ids, 0:2] = position
+        self.key_points[rows] = key_points
+        return key_points
+
+    def predict(self, track_ids, timestamp):
+        """
+        Returns the last filtered key points (N x 25 x 3) of the given tracks, with the filtered key points moved
+        forward to `timestamp` at their current velocity, by no more than `max_lead` seconds
+        """
+        rows = np.array([self.rows[track_id] for track_id in track_ids], dtype=np.int64)
+        lead = np.clip(timestamp - self.timestamps[rows], 0, self.max_lead)[:, np.newaxis, np.newaxis]
+
+        key_points = self.key_points[rows]
+        key_points[:, self.key_point_ids, 0:2] = self.positions[rows] + self.velocities[rows] * lead
+        return key_points
+
+    def forget(self, track_id):
+        row = self.rows.pop(track_id, None)
+        if row is not None:
+            self.free_rows.append(row)
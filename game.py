@@ -7,9 +7,8 @@ A game to slap a logo in the other player's goal using your arms/hands as detect
 import argparse
 import logging
 import logging.config
-import random
+import time
 
-import numpy as np
 import pygame
 import pygame.camera
 import pymunk
@@ -18,97 +17,137 @@ from pygame.color import *
 from pygame.locals import *
 
 import camera
+from assets import load_font
 from constants import *
-from entities import ScoreCounter, GoalPost, PushBody, Player, Logo
-from pose_estimator import PoseEstimator
+from display import FramePresenter, ScaledDisplay, SkeletonOverlay, StaticLayer
+from entities import ScoreCounter, Player, PlayerStore, Logo
+from filters import KeypointFilter
+from logs import RateLimitFilter
+from inference import InferenceScheduler, InferenceWorker
+from metrics import registry, JsonLinesExporter, PrometheusExporter, Profiler
+from physics import FixedTimestep, World
+from pipeline import InferencePool, ProcessPipeline
+from pose_estimator import BACKENDS, PoseEstimator, RegionOfInterest, create_backend, parse_net_resolution
+from session import SessionRecorder
+from startup import Startup
+from tracking import PoseTracker
 
 logging.config.fileConfig('logging.conf')
 
 pymunk.pygame_util.positive_y_is_up = False
 
 
-def convert_array_to_pygame_layout(img_array):
-    img_array = np.swapaxes(img_array, 0, 1).astype(np.uint8)
-    img_array = np.flip(img_array, axis=2)
-    return img_array
-
-
 class PoseLogoSlapGame(object):
     """
     Main game class
     """
 
-    def __init__(self, screen_dims, image_path, pose_estimator, frame_grabber, gpu_mode, debug_mode):
+    def __init__(self, screen_dims, image_path, pose_estimator, frame_grabber, gpu_mode, debug_mode,
+                 inference_worker=None, prewarm_rotations=False, display_dims=None, scaling=DISPLAY_SCALING):
         self.logger = logging.getLogger(self.__class__.__name__)
+        # Some debug messages are logged for every frame. Games share the logger, so only add the filter once
+        if not any(isinstance(log_filter, RateLimitFilter) for log_filter in self.logger.filters):
+            self.logger.addFilter(RateLimitFilter())
 
-        # Physics
-        self.space = pymunk.Space()
-        # self.space.gravity = (0.0, 600.0)
-        self.space.damping = DAMPING
-        self.space.add_collision_handler(COLLTYPE_LOGO, COLLTYPE_GOAL).separate = GoalPost.goal_scored_handler
+        # Physics, the world is built in init_game
+        self.world = None
+        self.space = None
+        self.timestep = FixedTimestep()
 
         # PyGame
         pygame.init()
+        # Everything is rendered at screen_dims, only the finished frame is scaled to display_dims
         self.screen_dims = screen_dims
-        self.screen = pygame.display.set_mode(self.screen_dims)
+        self.output = ScaledDisplay(screen_dims, display_dims, scaling)
+        self.screen = self.output.surface
         self.clock = pygame.time.Clock()
         self.draw_options = pymunk.pygame_util.DrawOptions(self.screen)
+        self.presenter = FramePresenter(self.screen)
+        self.static_layer = StaticLayer(self.screen_dims, THECOLORS["white"])
+        # Draws the skeletons when the pose backend doesn't render them
+        self.skeleton_overlay = None
+        # Areas of the screen to update, None for the whole screen
+        self.dirty_rects = None
+        self.drawn_logo_rect = None
 
         self.image_path = image_path
         self.logo = None
+        self.logo_rotations = None
+        self.prewarm_rotations = prewarm_rotations
 
+        self.push_bodies = None
         self.test_push_body = None
+        # Number of players to tune the physics for in crowd mode, None without
+        self.crowd_players = None
         self.players = set()
+        self.player_store = None
+        self.hand_grace_period = HAND_GRACE_PERIOD
+        self.player_grace_period = PLAYER_GRACE_PERIOD
+        self.reset_grace_period = RESET_GRACE_PERIOD
+        # Since when the field is empty, None while there are players
+        self.empty_since = None
+        # State of the world at the start of a round, restored on every reset
+        self.round_start = None
+        self.tracker = PoseTracker()
+        self.keypoint_filter = KeypointFilter()
 
         # Setup pose estimator
         self.pose_estimator = pose_estimator
         self.frame_grabber = frame_grabber
+        self.inference_worker = inference_worker
+        # Future of the (pose estimator, inference worker) that are still loading, the camera feed is shown meanwhile
+        self.warm_up = None
+        self.startup = None
         self.output_frame = None
+        self.output_seq = None
+        self.displayed_seq = None
         self.pose_input_frame = None
+        self.pose_input = None
+        self.frame_seq = 0
+        self.frame_timestamp = None
+        self.recorder = None
+
+        # Same clock as the frame timestamps
+        self.time_source = time.monotonic
+
+        # Wall time covered by the current frame
+        self.dt = DT
 
         self.gpu_mode = gpu_mode
         self.debug_mode = debug_mode
         self.running = True
         self.fullscreen = False
+        self.profiler = Profiler()
 
     def init_game(self):
-        self.setup_screen_bounds(screen_dims)
+        screen_dims = self.screen_dims
 
         # the right counter, is updated when the left goal gets a goal and vice versa
         right_counter = ScoreCounter((screen_dims[0] - 2 * COUNTER_MARGIN, COUNTER_MARGIN))
         left_counter = ScoreCounter((COUNTER_MARGIN, COUNTER_MARGIN))
 
-        static_body = self.space.static_body
-        goal_length = screen_dims[1] * RELATIVE_GOAL_SIZE
-        self.left_goal = GoalPost(static_body, (GOAL_MARGIN, (screen_dims[1] / 2 - goal_length / 2)),
-                                  (GOAL_MARGIN, (screen_dims[1] / 2 + goal_length / 2)), GOAL_MARGIN, right_counter)
-        self.right_goal = GoalPost(static_body, (screen_dims[0] - GOAL_MARGIN, (screen_dims[1] / 2 - goal_length / 2)),
-                                   (screen_dims[0] - GOAL_MARGIN, (screen_dims[1] / 2 + goal_length / 2)),
-                                   GOAL_MARGIN, left_counter)
-        self.space.add([self.left_goal, self.right_goal])
+        self.world = World(screen_dims, left_counter, right_counter, crowd_players=self.crowd_players)
+        self.space = self.world.space
+        self.left_goal = self.world.left_goal
+        self.right_goal = self.world.right_goal
+        self.push_bodies = self.world.push_bodies
+        self.player_store = PlayerStore(self.push_bodies, self.hand_grace_period)
+        if self.crowd_players:
+            registry.set_gauge("physics.culled", lambda: self.world.culled_count)
 
         self.init_logo()
         pygame.display.set_icon(self.logo.image)
 
+        # Share the rotated logos between resets
+        self.logo_rotations = self.logo.rotations
+        if self.prewarm_rotations:
+            self.logo_rotations.prewarm()
+
+        self.round_start = self.world.snapshot()
+
     def init_logo(self):
-        mid_point = (self.screen_dims[0] / 2, self.screen_dims[1] / 2)
-        quarter_screen_dims = (mid_point[0] / 2, mid_point[1] / 2)
-        x = random.randint(mid_point[0] - quarter_screen_dims[0], mid_point[0] + quarter_screen_dims[0])
-        y = random.randint(mid_point[1] - quarter_screen_dims[1], mid_point[1] + quarter_screen_dims[1])
-        self.logo = Logo(pymunk.Vec2d(x, y), self.image_path)
-        self.space.add(self.logo.box.body, self.logo.box)
-
-    def setup_screen_bounds(self, screen_dims):
-        # Setup bounding box around the screen, the lines start in the top left and go clockwise
-        static_body = self.space.static_body
-        static_lines = [pymunk.Segment(static_body, (0, 0), (screen_dims[0], 0), 0.0),
-                        pymunk.Segment(static_body, (screen_dims[0], 0), (screen_dims[0], screen_dims[1]), 0.0),
-                        pymunk.Segment(static_body, (screen_dims[0], screen_dims[1]), (0, screen_dims[1]), 0.0),
-                        pymunk.Segment(static_body, (0, screen_dims[1]), (0, 0), 0.0)]
-        for line in static_lines:
-            line.elasticity = 0.95
-            line.friction = 0.9
-        self.space.add(static_lines)
+        box = self.world.spawn_logo()
+        self.logo = Logo(box.body.position, self.image_path, rotations=self.logo_rotations, box=box)
 
     def run(self):
         """
@@ -117,24 +156,64 @@ class PoseLogoSlapGame(object):
         """
 
         self.logger.info("Starting game loop")
+        self.clock.tick()
         while self.running:
-            # Progress time forward
-            for _ in range(PHYSICS_STEPS_PER_FRAME):
-                self.space.step(DT)
+            # Delay between frames, if we're faster than the cap
+            frame_time = self.clock.tick(FRAME_RATE_CAP) / 1000.0
+            self.tick(frame_time)
 
-            self.process_events()
-            self.load_new_frame()
-            if self.gpu_mode:
-                self.update_poses()
-            self.logo.update()
+            pygame.display.set_caption("fps: " + str(self.clock.get_fps()))
 
-            self.clear_screen()
-            self.draw_objects()
-            pygame.display.flip()
+    def tick(self, frame_time):
+        """
+        A single iteration of the main loop: physics, input, poses and drawing.
+        :param frame_time: wall time in seconds since the previous iteration
+        :return: None
+        """
+        with registry.timer("frame"):
+            # Input events divide by dt, so never let it be 0
+            self.dt = max(frame_time, 0.001)
+            with registry.timer("physics"):
+                self.step_physics(frame_time)
 
-            # Delay fixed time between frames
-            self.clock.tick(50)
-            pygame.display.set_caption("fps: " + str(self.clock.get_fps()))
+            self.process_events()
+            if self.warm_up is not None and self.warm_up.done() and self.warm_up.exception():
+                # Logged by the startup
+                self.logger.error("The pose estimator failed to load, quitting")
+                self.running = False
+                self.warm_up = None
+            if self.warm_up is not None and self.warm_up.done():
+                self.pose_estimator, self.inference_worker = self.warm_up.result()
+                self.warm_up = None
+                self.pose_input_frame = None
+                self.pose_input = None
+            if self.inference_worker:
+                # The worker consumes the camera frames and hands back the rendered output with the poses
+                self.apply_inference_result()
+            else:
+                self.load_new_frame()
+                if self.gpu_mode and self.pose_estimator:
+                    self.update_poses()
+            with registry.timer("prediction"):
+                self.predict_hands()
+            self.logo.update(self.timestep.alpha())
+
+            with registry.timer("conversion"):
+                self.clear_screen()
+            with registry.timer("drawing"):
+                self.draw_objects()
+                self.update_display()
+
+    def step_physics(self, frame_time):
+        """
+        Progress time forward, in as many fixed steps as the wall time since the previous frame requires
+        :return: None
+        """
+        if self.world.crowd_mode:
+            self.world.cull_push_bodies()
+        for _ in range(self.timestep.advance(frame_time)):
+            self.logo.store_state()
+            self.space.step(self.timestep.dt)
 
     def process_events(self):
         """
@@ -150,44 +229,70 @@ class PoseLogoSlapGame(object):
                 self.reset_game()
             elif event.type == KEYDOWN and event.key == K_d:
                 self.debug_mode = not self.debug_mode
+            elif event.type == KEYDOWN and event.key == K_p:
+                self.profiler.toggle()
             elif event.type == KEYDOWN and event.key == K_f:
                 if self.fullscreen:
-                    pygame.display.set_mode(self.screen_dims)
+                    self.set_display_mode(0)
                     self.fullscreen = False
                 else:
-                    pygame.display.set_mode(self.screen_dims, flags=FULLSCREEN)
+                    self.set_display_mode(FULLSCREEN)
                     self.fullscreen = True
             elif event.type == MOUSEBUTTONDOWN:
                 if not self.test_push_body:
-                    pos = pygame.mouse.get_pos()
-                    self.test_push_body = PushBody(pymunk.Vec2d(pos[0], pos[1]))
-                    self.space.add(self.test_push_body.body, self.test_push_body.shape)
+                    pos = self.output.to_surface(pygame.mouse.get_pos())
+                    self.test_push_body = self.push_bodies.acquire(pymunk.Vec2d(pos[0], pos[1]))
             elif event.type == MOUSEMOTION:
                 if self.test_push_body:
-                    pos = pygame.mouse.get_pos()
+                    pos = self.output.to_surface(pygame.mouse.get_pos())
                     new_pos = pymunk.Vec2d(pos[0], pos[1])
                     self.test_push_body.move(new_pos, self.dt)
             elif event.type == MOUSEBUTTONUP:
                 if self.test_push_body:
-                    self.space.remove(self.test_push_body.shape, self.test_push_body.body)
+                    self.push_bodies.release(self.test_push_body)
                 self.test_push_body = None
             elif event.type == KEYDOWN and event.key == K_SPACE:
-                self.update_poses()
+                # Not before the model finished loading
+                if self.pose_estimator:
+                    self.update_poses()
+
+    def set_display_mode(self, flags):
+        """
+        Switches display mode, the display surface may change with it
+        :return: None
+        """
+        self.screen = self.output.set_mode(flags)
+        self.draw_options = pymunk.pygame_util.DrawOptions(self.screen)
+        self.presenter = FramePresenter(self.screen)
+        self.drawn_logo_rect = None
 
     def clear_screen(self):
         """
-        Clears the screen.
+        Clears the screen. Without a camera frame only the area under the logo is cleared, if nothing else changed.
         :return: None
         """
 
         if self.pose_input_frame is not None:
             # Input frame has not been processed yet
-            self.output_frame = convert_array_to_pygame_layout(self.pose_input_frame)
+            self.output_frame = self.pose_input_frame
+            self.output_seq = self.frame_seq
 
+        layer_changed = self.static_layer.update([self.left_goal, self.right_goal])
         if self.output_frame is not None:
-            pygame.surfarray.blit_array(self.screen, self.output_frame)
+            self.presenter.present(self.output_frame)
+            if self.output_seq != self.displayed_seq:
+                if self.displayed_seq is None and self.startup:
+                    self.startup.mark("first_frame")
+                registry.trace(self.output_seq, "displayed")
+                self.displayed_seq = self.output_seq
+            self.dirty_rects = None
+        elif layer_changed or self.debug_mode or self.skeleton_overlay or self.drawn_logo_rect is None:
+            self.screen.blit(self.static_layer.background, (0, 0))
+            self.dirty_rects = None
         else:
-            self.screen.fill(THECOLORS["white"])
+            # Only the logo moved, erase it from its previous position
+            self.screen.blit(self.static_layer.background, self.drawn_logo_rect, self.drawn_logo_rect)
+            self.dirty_rects = [self.drawn_logo_rect]
 
     def draw_objects(self):
         """
@@ -199,104 +304,370 @@ class PoseLogoSlapGame(object):
             self.space.debug_draw(self.draw_options)
 
         self.screen.blit(self.logo.image, self.logo.rect.topleft)
-        self.screen.blit(self.left_goal.counter.text, self.left_goal.counter.pos)
-        self.screen.blit(self.right_goal.counter.text, self.right_goal.counter.pos)
+        self.static_layer.draw(self.screen)
 
-        pygame.draw.line(self.screen, OBJECT_COLOR, self.right_goal.a, self.right_goal.b, GOAL_MARGIN)
-        pygame.draw.line(self.screen, OBJECT_COLOR, self.left_goal.a, self.left_goal.b, GOAL_MARGIN)
+        if self.skeleton_overlay:
+            self.draw_skeletons()
+
+    def draw_skeletons(self):
+        """
+        Draws the skeletons and hands of the players currently seen
+        """
+        players = [player for player in self.players if player.visible and player.key_points is not None]
+        if not players:
+            return
+
+        store = self.player_store
+        rows = Player.rows(players)
+        poses = store.key_points[rows]
+        hands = [hand.body.position for hand in store.hands[rows].flat if hand]
+        self.skeleton_overlay.draw(self.screen, poses, hands)
+
+    def update_display(self):
+        """
+        Shows what was drawn, only pushing the dirty areas to the display if possible.
+        :return: None
+        """
+        if self.dirty_rects is None:
+            self.output.update()
+        else:
+            self.dirty_rects.append(self.logo.rect)
+            self.output.update(self.dirty_rects)
+
+        if self.output_frame is None and not self.debug_mode:
+            self.drawn_logo_rect = self.logo.rect.copy()
+        else:
+            self.drawn_logo_rect = None
 
     def update_poses(self):
-        if self.pose_input_frame is None:
+        """
+        Runs the pose estimator on the pending input frame and waits for the result.
+        """
+        if self.pose_input_frame is None or self.pose_estimator is None:
             return
 
-        datum = self.pose_estimator.grab_pose(self.pose_input_frame)
+        with registry.timer("inference"):
+            estimate = self.pose_estimator.estimate(self.pose_input)
         self.pose_input_frame = None
+        self.pose_input = None
 
-        num_poses = len(datum.poseKeypoints) if datum.poseKeypoints.ndim > 0 else 0
-        self.logger.debug("Number of poses detected: %d", num_poses)
-        if num_poses == 0:
-            if len(self.players) > 0:
-                self.reset_game()
+        self.apply_poses(estimate.key_points, estimate.output_frame)
+
+    def apply_inference_result(self):
+        """
+        Applies the newest result of the inference worker, if there is one. Never waits for the estimator.
+        """
+        result = self.inference_worker.pop_result()
+        if result is None:
             return
 
-        new_players = set()
-        for pose in datum.poseKeypoints:
-            player = self.find_nearest_player(pose)
-            if not player:
-                player = Player(self.space)
+        self.frame_seq = result.seq
+        self.frame_timestamp = result.timestamp
+        if result.key_points is None:
+            # A frame the estimator skipped, shown with the poses found before
+            self.output_frame = result.output_frame
+            self.output_seq = result.seq
+            return
 
-            player.update_pose(pose, self.dt)
-            new_players.add(player)
+        self.apply_poses(result.key_points, result.output_frame)
 
-        old_players = self.players - new_players
-        self.logger.debug("Removing " + str(len(old_players)) + " players")
-        for old_player in old_players:
-            old_player.destroy()
+    def apply_poses(self, key_points, output_frame):
+        with registry.timer("tracking"):
+            self.track_poses(key_points, output_frame)
+        registry.trace(self.frame_seq, "applied")
 
-        self.logger.debug("Keeping/adding " + str(len(new_players)))
-        self.players = new_players
+    def track_poses(self, key_points, output_frame):
+        if output_frame is not None:
+            self.output_frame = output_frame
+            self.output_seq = self.frame_seq
+        if self.recorder:
+            self.recorder.record_pose(self.frame_seq, self.frame_timestamp, key_points)
 
-        self.output_frame = convert_array_to_pygame_layout(datum.cvOutputData)
+        num_poses = len(key_points)
+        self.logger.debug("Number of poses detected: %d", num_poses)
+        timestamp = self.frame_timestamp if self.frame_timestamp is not None else self.time_source()
+
+        seen_players = []
+        if num_poses > 0:
+            for player in self.tracker.match(key_points, list(self.players)):
+                seen_players.append(player if player else self.player_store.add(self.tracker.new_track_id()))
+
+            filtered = self.keypoint_filter.update([player.track_id for player in seen_players], key_points,
+                                                   timestamp)
+            # The hands follow in predict_hands
+            self.player_store.set_poses(seen_players, filtered, timestamp)
+
+        # Players that weren't seen are kept for a grace period, in case they were only missed by the estimator
+        missing_players = self.players - set(seen_players)
+        old_players = set(player for player in missing_players
+                          if timestamp - player.last_seen > self.player_grace_period)
+        for old_player in old_players:
+            old_player.destroy()
+            self.keypoint_filter.forget(old_player.track_id)
+        for player in missing_players:
+            player.visible = False
+
+        self.logger.debug("Removing %d players, keeping/adding %d", len(old_players), len(seen_players))
+        self.players = set(seen_players) | (missing_players - old_players)
+
+        # The game is only reset once the field stayed empty for a while, players that come back keep their scores
+        if self.players:
+            self.empty_since = None
+        elif old_players:
+            self.empty_since = timestamp
+        if self.empty_since is not None and timestamp - self.empty_since > self.reset_grace_period:
+            self.reset_game()
+
+    def predict_hands(self):
+        """
+        Moves the hands of every player towards where they are predicted to be right now
+        :return: None
+        """
+        if not self.players:
+            return
 
-    def find_nearest_player(self, pose):
-        nearest_player = None
-        closest_distance = MAX_DISTANCE_THRESHOLD
-        for player in self.players:
-            distance = player.distance(pose)
-            if distance < closest_distance:
-                nearest_player = player
-                closest_distance = distance
+        players = [player for player in self.players if player.visible]
+        if players:
+            predicted = self.keypoint_filter.predict([player.track_id for player in players], self.time_source())
+            self.player_store.update_poses(players, predicted, self.dt)
 
-        return nearest_player
+        hidden_players = [player for player in self.players if not player.visible]
+        if hidden_players:
+            self.player_store.hold(hidden_players, self.dt)
 
     def reset_game(self):
-        self.logger.debug("Resetting game, previous scores:")
-        self.logger.debug("Left team scored " + str(self.right_goal.counter.score))
-        self.logger.debug("Right team scored " + str(self.left_goal.counter.score))
-
-        self.right_goal.reset()
-        self.left_goal.reset()
+        self.logger.info("Resetting game, left team scored %d, right team scored %d", self.right_goal.counter.score,
+                         self.left_goal.counter.score)
 
         for player in self.players:
             player.destroy()
+            self.keypoint_filter.forget(player.track_id)
 
         self.players = set()
-        self.space.remove(self.logo.box, self.logo.box.body)
-        self.init_logo()
+        self.empty_since = None
+
+        # Back to the start of a round in place, the logo's body and sprite are reused
+        self.world.restore(self.round_start)
+        self.world.spawn_logo()
+        self.logo.reset()
+        self.drawn_logo_rect = None
 
     def load_new_frame(self):
         frame = self.frame_grabber.pop_frame()
         if frame is None:
             return
 
-        self.pose_input_frame = frame
+        self.pose_input = frame
+        self.pose_input_frame = frame.image
+        self.frame_seq = frame.seq
+        self.frame_timestamp = frame.timestamp
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='A silly game based on OpenPose')
     parser.add_argument('--cam_id', default="0", type=int, help='Camera id (0 = built-in, 1 = external)')
+    parser.add_argument('--source', help='Frame source instead of the camera: a video file, or "synthetic"')
+    parser.add_argument('--max_speed', action='store_true',
+                        help='If provided, video files and synthetic frames are read as fast as possible')
+    parser.add_argument('--fourcc', default=CAMERA_FOURCC, help='Codec to ask the camera for, empty for its default')
     parser.add_argument('--fps', type=int, default=30, help='Frames per second')
-    parser.add_argument('--width', type=int, default=1280, help='Capture and display width')
-    parser.add_argument('--height', type=int, default=720, help='Capture and display height')
+    parser.add_argument('--width', type=int, default=1280, help='Capture and render width')
+    parser.add_argument('--height', type=int, default=720, help='Capture and render height')
+    parser.add_argument('--display_width', type=int,
+                        help='If provided, scales the rendered frames up, to this width with --scaling smooth')
+    parser.add_argument('--display_height', type=int,
+                        help='If provided, scales the rendered frames up, to this height with --scaling smooth')
+    parser.add_argument('--scaling', default=DISPLAY_SCALING, choices=("scaled", "smooth"),
+                        help='How frames are scaled to the display: by SDL ("scaled") or with smoothscale ("smooth")')
+    parser.add_argument('--frame_buffer_size', type=int, default=FRAME_BUFFER_SIZE,
+                        help='Number of captured frames kept, the newest one is always used')
+    parser.add_argument('--max_frame_age', type=float, default=MAX_FRAME_AGE,
+                        help='Frames older than this many seconds are discarded as stale')
     parser.add_argument('--fullscreen', action='store_true', dest='fullscreen',
                         help='If provided, displays in fullscreen')
     parser.add_argument("--model_path", default="/opt/openpose/models/", help="Path to the model directory")
     parser.add_argument("--image_path", default="/opt/anchormen/logo.png", help="Path to the logo")
     parser.add_argument("--net_resolution", default="-1x368", help="Net resolution, see openpose -> flags.hpp")
+    parser.add_argument("--downscale", action="store_true",
+                        help="If provided, frames are downscaled to the net resolution before inference")
+    parser.add_argument("--roi", action="store_true",
+                        help="If provided, inference runs on the area around the previous skeletons")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="If provided, adapts the net resolution and inference rate to a latency budget")
+    parser.add_argument("--net_resolutions", default=",".join(INFERENCE_NET_RESOLUTIONS),
+                        help="Comma separated net resolutions the adaptive mode chooses from, best first")
+    parser.add_argument("--latency_budget", type=float, default=INFERENCE_LATENCY_BUDGET,
+                        help="Seconds inference may take in adaptive mode")
+    parser.add_argument("--draw_skeletons", action="store_true",
+                        help="If provided, the game draws the skeletons instead of the pose backend")
+    parser.add_argument("--backend", default="openpose", choices=BACKENDS,
+                        help="Pose estimation backend, opencv only finds a single player")
+    parser.add_argument("--synthetic_players", type=int, default=2,
+                        help="Number of skeletons produced by the synthetic backend")
+    parser.add_argument("--backend_cost", type=float, default=0.0,
+                        help="Seconds the synthetic and replay backends spend per frame")
+    parser.add_argument("--replay_path", help="Key point sequence (.npz) for the replay backend")
     parser.add_argument("--gpu", action="store_true")
+    parser.add_argument("--sync_inference", action="store_true",
+                        help="If provided, runs the pose estimator inside the game loop instead of next to it")
+    parser.add_argument("--hand_grace_period", type=float, default=HAND_GRACE_PERIOD,
+                        help="Seconds a hand may go undetected before it's removed")
+    parser.add_argument("--player_grace_period", type=float, default=PLAYER_GRACE_PERIOD,
+                        help="Seconds a player may go undetected before it's removed")
+    parser.add_argument("--reset_grace_period", type=float, default=RESET_GRACE_PERIOD,
+                        help="Seconds the field may be empty before the game is reset")
+    parser.add_argument("--crowd", type=int, metavar="PLAYERS",
+                        help="If provided, tunes the physics for this many players and ignores hands far from the logo")
+    parser.add_argument("--processes", action="store_true",
+                        help="If provided, runs capture and inference in processes of their own, using shared memory")
+    parser.add_argument("--pool", type=int, metavar="WORKERS",
+                        help="If provided, runs this many pose estimators in processes of their own, for CPU inference")
+    parser.add_argument("--record", help="If provided, records the session (frames and poses) to this file")
+    parser.add_argument("--prewarm_rotations", action="store_true",
+                        help="If provided, renders all rotations of the logo at startup")
+    parser.add_argument("--metrics_json", help="If provided, appends metrics to this file as JSON lines")
+    parser.add_argument("--metrics_port", type=int, help="If provided, serves metrics on localhost:PORT/metrics")
+    parser.add_argument("--metrics_interval", type=float, default=METRICS_INTERVAL,
+                        help="Seconds between JSON metrics lines")
+    parser.add_argument("--log_config", help="If provided, configures logging from this file instead of logging.conf, "
+                                              "e.g. logging.production.conf to log without blocking the game loop")
     parser.add_argument("--debug", action="store_true")
     args = parser.parse_args()
+    if args.log_config:
+        logging.config.fileConfig(args.log_config, disable_existing_loggers=False)
+    if args.processes and (args.record or args.sync_inference):
+        parser.error("--processes can't be combined with --record or --sync_inference")
+    if args.pool and (args.processes or args.sync_inference):
+        parser.error("--pool can't be combined with --processes or --sync_inference")
+    if args.backend == "opencv" and args.crowd:
+        parser.error("--backend opencv finds a single player, it can't be combined with --crowd")
 
     logger = logging.getLogger(__name__)
     logger.info(args)
+    if args.backend == "opencv":
+        logger.warning("The opencv backend finds a single player at most, use openpose to play against each other")
 
     screen_dims = (args.width, args.height)
-    pose_estimator = PoseEstimator(args.model_path, args.net_resolution)
-    grabber = camera.FrameGrabber(screen_dims[0], screen_dims[1], args.cam_id, args.fps)
-    grabber.start()
-
-    game = PoseLogoSlapGame(screen_dims, args.image_path, pose_estimator, grabber, args.gpu, args.debug)
+    display_dims = None
+    if args.display_width or args.display_height:
+        # The missing side follows the aspect ratio of the render resolution
+        display_width = args.display_width or int(round(args.display_height * args.width / float(args.height)))
+        display_height = args.display_height or int(round(args.display_width * args.height / float(args.width)))
+        display_dims = (display_width, display_height)
+    backend_args = dict(name=args.backend, model_path=args.model_path, net_resolution=args.net_resolution,
+                        num_players=args.synthetic_players, cost=args.backend_cost, replay_path=args.replay_path,
+                        render=not args.draw_skeletons)
+    inference_size = parse_net_resolution(args.net_resolution, *screen_dims) if args.downscale else None
+    scheduler_args = None
+    if args.adaptive:
+        scheduler_args = dict(net_resolutions=args.net_resolutions.split(","), latency_budget=args.latency_budget)
+
+    source_spec = args.source if args.source else args.cam_id
+    exporters = []
+    if args.metrics_json:
+        exporters.append(JsonLinesExporter(args.metrics_json, args.metrics_interval))
+    if args.metrics_port:
+        exporters.append(PrometheusExporter(args.metrics_port))
+    for exporter in exporters:
+        exporter.start()
+
+    recorder = None
+    if args.record:
+        recorder = SessionRecorder(args.record)
+        recorder.start()
+
+    # The model, the camera and the fonts load side by side, while the display is set up
+    startup = Startup()
+    startup.submit("fonts", load_font, FONT_NAME, FONT_SIZE)
+    pipeline = None
+    if args.processes:
+        # The backend is only created in the inference process
+        pipeline = ProcessPipeline(screen_dims[0], screen_dims[1], source_spec, args.fps, inference_size,
+                                   backend_args if args.gpu else None, args.roi, args.max_frame_age, scheduler_args,
+                                   args.fourcc, not args.max_speed)
+        pipeline.start()
+
+        def open_camera():
+            if not pipeline.wait_until_capturing():
+                raise Exception("Stopped before the first frame")
+            return pipeline.frames
+
+        def load_model():
+            if pipeline.inference is None:
+                return None, None
+            if not pipeline.wait_until_ready(MODEL_LOAD_TIMEOUT):
+                raise Exception("The inference process didn't load its model")
+            return None, pipeline.inference
+    else:
+        def open_camera():
+            source = camera.create_frame_source(source_spec, screen_dims[0], screen_dims[1], args.fps, args.fourcc,
+                                                not args.max_speed)
+            grabber = camera.FrameGrabber(screen_dims[0], screen_dims[1], args.cam_id, args.fps,
+                                          args.frame_buffer_size, args.max_frame_age, inference_size, source)
+            grabber.recorder = recorder
+            grabber.start()
+            return grabber
+
+        def load_model():
+            if args.pool:
+                # The backends are only created in the pool's processes
+                pool = InferencePool(startup.result("camera"), args.pool, screen_dims[0], screen_dims[1],
+                                     inference_size, backend_args, args.roi, scheduler_args)
+                pool.start()
+                try:
+                    if not pool.wait_until_ready(MODEL_LOAD_TIMEOUT):
+                        raise Exception("No inference pool worker loaded its model in %.0f s" % MODEL_LOAD_TIMEOUT)
+                except Exception:
+                    pool.stop()
+                    raise
+                return None, pool
+
+            pose_estimator = PoseEstimator(create_backend(**backend_args), RegionOfInterest() if args.roi else None)
+            worker = None
+            if args.gpu and not args.sync_inference:
+                scheduler = InferenceScheduler(pose_estimator, **scheduler_args) if scheduler_args else None
+                worker = InferenceWorker(pose_estimator, startup.result("camera"), scheduler)
+                worker.start()
+            return pose_estimator, worker
+
+    startup.submit("camera", open_camera)
+    startup.submit("model", load_model)
+
+    game = PoseLogoSlapGame(screen_dims, args.image_path, None, None, args.gpu, args.debug, None,
+                            args.prewarm_rotations, display_dims, args.scaling)
+    if args.fullscreen:
+        game.set_display_mode(FULLSCREEN)
+        game.fullscreen = True
+    game.startup = startup
+    game.recorder = recorder
+    game.hand_grace_period = args.hand_grace_period
+    game.player_grace_period = args.player_grace_period
+    game.reset_grace_period = args.reset_grace_period
+    game.crowd_players = args.crowd
+    if args.draw_skeletons:
+        game.skeleton_overlay = SkeletonOverlay()
     game.init_game()
+    startup.mark("display")
+
+    # Until the model is ready, the game shows the camera frames itself
+    game.frame_grabber = startup.result("camera")
+    game.warm_up = startup.stages["model"]
     game.run()
 
-    grabber.stop()
+    if pipeline:
+        pipeline.stop()
+    else:
+        # Waits for the model if the game was quit before it finished loading
+        try:
+            worker = startup.result("model", MODEL_LOAD_TIMEOUT)[1]
+        except Exception:
+            # Failed to load, which the startup logged, or still loading
+            worker = None
+        if worker:
+            worker.stop()
+        game.frame_grabber.stop()
+    startup.shutdown()
+    if recorder:
+        recorder.stop()
+    for exporter in exporters:
+        exporter.stop()
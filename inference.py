@@ -0,0 +1,261 @@
+"""
+Runs the pose estimator next to the game loop, so slow inference doesn't hold back physics and drawing.
+
+@author: Jeroen Vlek <j.vlek@anchormen.nl>
+"""
+
+import collections
+import logging
+import threading
+import time
+
+import cv2
+
+from constants import *
+from metrics import registry
+from pose_estimator import parse_net_resolution
+
+PoseResult = collections.namedtuple('PoseResult', ['seq', 'timestamp', 'key_points', 'output_frame', 'latency'])
+
+
+class ResultSlot(object):
+    """
+    Double-buffered hand-over of the newest result from a single producer to a single consumer.
+
+    The producer fills the back buffer and swaps it to the front, the consumer only ever takes the front. Neither side
+    waits for the other; results that are replaced before being consumed are counted as overwritten.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.front = None
+        self.back = None
+        self.fresh = False
+        self.published = 0
+        self.overwritten = 0
+
+    def publish(self, result):
+        self.back = result
+        with self.lock:
+            self.front, self.back = self.back, self.front
+            if self.fresh:
+                self.overwritten += 1
+            self.fresh = True
+            self.published += 1
+
+    def consume(self):
+        """
+        Returns the newest result, or None if it was already consumed.
+        """
+        with self.lock:
+            if not self.fresh:
+                return None
+
+            self.fresh = False
+            return self.front
+
+    def pending(self):
+        """
+        Returns the newest result if it wasn't consumed yet, otherwise None
+        """
+        with self.lock:
+            return self.front if self.fresh else None
+
+
+class InferenceScheduler(object):
+    """
+    Adapts the pose estimator to a latency budget, measuring its latency as it goes.
+
+    It steps down through `net_resolutions` while the smoothed latency is over budget, and back up when the next
+    resolution is predicted to fit, by pixel count, with some headroom. The backend is switched to the current
+    resolution and frames are downscaled to it. A backend that can't switch on the fly, like OpenPose, would only scale
+    the frames back up to its fixed net input, so then the resolution stays as it is and only the inference rate
+    adapts. When even the lowest resolution is over budget, frames are skipped so the estimator is busy for at most
+    `max_duty` of the time. Without players for `idle_after` seconds it idles: it runs at the lowest resolution, once
+    every `idle_interval` seconds, until someone shows up.
+    """
+
+    def __init__(self, pose_estimator, net_resolutions=INFERENCE_NET_RESOLUTIONS,
+                 latency_budget=INFERENCE_LATENCY_BUDGET, smoothing=INFERENCE_LATENCY_SMOOTHING,
+                 cooldown=INFERENCE_SWITCH_COOLDOWN, idle_after=IDLE_AFTER, idle_interval=IDLE_INTERVAL, headroom=0.8,
+                 max_duty=0.75):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.pose_estimator = pose_estimator
+        self.net_resolutions = list(net_resolutions)
+        self.latency_budget = latency_budget
+        self.smoothing = smoothing
+        self.cooldown = cooldown
+        self.idle_after = idle_after
+        self.idle_interval = idle_interval
+        self.headroom = headroom
+        self.max_duty = max_duty
+
+        self.level = 0
+        self.backend_resolution = None
+        # Whether the backend can't switch net resolutions, in which case frames aren't downscaled either
+        self.fixed_resolution = False
+        self.latency = None
+        self.last_switch = None
+        self.last_seen = None
+        self.idle = False
+        self.next_run = 0.0
+
+        registry.set_gauge("inference.level", lambda: self.level)
+        registry.set_gauge("inference.idle", lambda: int(self.idle))
+
+    def ready(self, now):
+        """
+        Whether to run the estimator on a frame that arrives at `now`, or skip it
+        """
+        return now >= self.next_run
+
+    def estimate(self, frame):
+        """
+        Estimates the poses in a CapturedFrame at the current resolution, returns a PoseEstimate
+        """
+        start = time.monotonic()
+        level = len(self.net_resolutions) - 1 if self.idle else self.level
+        net_resolution = self.net_resolutions[level]
+        if not self.fixed_resolution and net_resolution != self.backend_resolution:
+            if self.pose_estimator.backend.set_net_resolution(net_resolution):
+                self.backend_resolution = net_resolution
+            else:
+                self.logger.info("The backend can't switch its net resolution, only adapting the inference rate")
+                self.fixed_resolution = True
+                self.net_resolutions = self.net_resolutions[0:1]
+                level = self.level = 0
+
+        height, width = frame.image.shape[0:2]
+        if not self.fixed_resolution:
+            image = frame.inference_image if frame.inference_image is not None else frame.image
+            size = parse_net_resolution(net_resolution, width, height)
+            if size[0] < image.shape[1]:
+                frame = frame._replace(inference_image=cv2.resize(image, size, interpolation=cv2.INTER_AREA))
+
+        estimate = self.pose_estimator.estimate(frame)
+        end = time.monotonic()
+        self.update(level, end - start, len(estimate.key_points), end, (width, height))
+        return estimate
+
+    def update(self, level, latency, num_poses, now, frame_size):
+        if self.last_seen is None:
+            self.last_seen = self.last_switch = now
+
+        if num_poses > 0:
+            self.last_seen = now
+            if self.idle:
+                self.logger.info("Players showed up, leaving idle mode")
+                self.idle = False
+                self.next_run = now
+                return
+        elif not self.idle and now - self.last_seen > self.idle_after:
+            self.logger.info("No players for %.1f s, idling", now - self.last_seen)
+            self.idle = True
+
+        if self.idle:
+            self.next_run = now + self.idle_interval
+            return
+
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+
+        if now - self.last_switch >= self.cooldown:
+            if self.latency > self.latency_budget and self.level < len(self.net_resolutions) - 1:
+                self.switch(self.level + 1, now, frame_size)
+            elif self.level > 0 and self.latency * self.pixel_ratio(self.level - 1, self.level, frame_size) < \
+                    self.headroom * self.latency_budget:
+                self.switch(self.level - 1, now, frame_size)
+
+        self.next_run = now
+        if self.level == len(self.net_resolutions) - 1 and self.latency > self.latency_budget:
+            self.next_run += self.latency * (1.0 / self.max_duty - 1.0)
+
+    def switch(self, level, now, frame_size):
+        self.logger.info("Smoothed inference latency %.0f ms, switching net resolution from %s to %s",
+                         self.latency * 1000, self.net_resolutions[self.level], self.net_resolutions[level])
+        # Assume the latency scales with the number of pixels until it's been measured
+        self.latency *= self.pixel_ratio(level, self.level, frame_size)
+        self.level = level
+        self.last_switch = now
+
+    def pixel_ratio(self, level, other_level, frame_size):
+        size = parse_net_resolution(self.net_resolutions[level], *frame_size)
+        other_size = parse_net_resolution(self.net_resolutions[other_level], *frame_size)
+        return float(size[0] * size[1]) / (other_size[0] * other_size[1])
+
+
+class InferenceWorker(threading.Thread):
+    """
+    Feeds the latest camera frame to the pose estimator and publishes its results, in a loop.
+
+    With a scheduler, it decides which frames to run on and at which resolution. The frames it skips are published
+    without key points, so the game keeps showing the camera feed, unless they'd replace poses the game didn't take yet
+    or the backend draws the skeletons, which would then flicker.
+    """
+
+    def __init__(self, pose_estimator, frame_grabber, scheduler=None):
+        super().__init__(daemon=True)
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.pose_estimator = pose_estimator
+        self.frame_grabber = frame_grabber
+        self.scheduler = scheduler
+        self.results = ResultSlot()
+        self.running = True
+        # Whether skipped frames look the same as estimated ones, which they don't if skeletons are rendered onto those
+        self.show_skipped = True
+
+        registry.set_gauge("inference.published", lambda: self.results.published)
+        registry.set_gauge("inference.overwritten", lambda: self.results.overwritten)
+
+    def run(self):
+        self.logger.info("Starting InferenceWorker")
+
+        while self.running:
+            frame = self.frame_grabber.wait_for_frame(timeout=0.1)
+            if frame is None:
+                continue
+
+            if self.scheduler and not self.scheduler.ready(time.monotonic()):
+                registry.increment("inference.skipped_frames")
+                self.publish_skipped(frame)
+                continue
+
+            start = time.monotonic()
+            if self.scheduler:
+                estimate = self.scheduler.estimate(frame)
+            else:
+                estimate = self.pose_estimator.estimate(frame)
+            latency = time.monotonic() - start
+            registry.observe("inference", latency)
+            registry.trace(frame.seq, "inference")
+
+            result = PoseResult(frame.seq, frame.timestamp, estimate.key_points, estimate.output_frame, latency)
+            self.results.publish(result)
+            self.show_skipped = estimate.output_frame is frame.image or not len(estimate.key_points)
+
+        self.logger.info("Published %d results, %d were overwritten before use",
+                         self.results.published, self.results.overwritten)
+
+    def publish_skipped(self, frame):
+        """
+        Publishes a frame the estimator skipped as a result without key points, if it may be shown
+        """
+        if not self.show_skipped:
+            return
+
+        pending = self.results.pending()
+        if pending is None or pending.key_points is None:
+            self.results.publish(PoseResult(frame.seq, frame.timestamp, None, frame.image, None))
+
+    def stop(self):
+        self.logger.info("Stopping InferenceWorker")
+        self.running = False
+
+    def pop_result(self):
+        """
+        Returns the newest PoseResult, or None if there is nothing new since the last call.
+        """
+        return self.results.consume()
@@ -0,0 +1,99 @@
+"""
+Logging that stays off the game loop: a handler that writes on a background thread, and rate limiting for messages
+logged every frame.
+
+Use logging.production.conf to log this way: python3 game.py --log_config logging.production.conf
+
+@author: Jeroen Vlek <j.vlek@anchormen.nl>
+"""
+
+import collections
+import logging
+import logging.handlers
+import queue
+import sys
+
+from constants import LOG_DEBUG_INTERVAL, LOG_QUEUE_SIZE
+from metrics import registry
+
+
+class _BlockingStopListener(logging.handlers.QueueListener):
+    """
+    Waits for room in a full queue to tell the thread to stop, instead of failing
+    """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on a bounded queue, from which a background thread formats them and writes them to `stream`.
+
+    Logging never waits for the stream: when the queue is full, the record is dropped and counted, and exported as the
+    logging.dropped gauge. Records are formatted on the background thread, so their arguments shouldn't be changed
+    after they're logged. The records still queued are written when the handler is closed, which logging does at exit.
+    """
+
+    def __init__(self, stream=sys.stdout, capacity=LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(capacity))
+        self.target = logging.StreamHandler(stream)
+        self.dropped = 0
+        self.listener = _BlockingStopListener(self.queue, self.target)
+        self.listener.start()
+        registry.set_gauge("logging.dropped", lambda: self.dropped)
+
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Formatting is left to the background thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+            if self.dropped:
+                self.target.stream.write("Dropped %d log records\n" % self.dropped)
+            self.target.close()
+        super().close()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets a message at or below `level` through at most once per `interval` seconds, per logger and message template.
+    The next one that gets through says how many were suppressed in between.
+
+    Meant for loggers that log every frame, add it with logger.addFilter.
+    """
+
+    def __init__(self, interval=LOG_DEBUG_INTERVAL, level=logging.DEBUG):
+        super().__init__()
+        self.interval = interval
+        self.level = level
+        self.last_passed = {}
+        self.suppressed = collections.Counter()
+
+    def filter(self, record):
+        if record.levelno > self.level:
+            return True
+
+        key = (record.name, record.msg)
+        last_passed = self.last_passed.get(key)
+        if last_passed is not None and record.created - last_passed < self.interval:
+            self.suppressed[key] += 1
+            return False
+
+        self.last_passed[key] = record.created
+        suppressed = self.suppressed.pop(key, 0)
+        if suppressed:
+            record.msg = "%s (%d similar messages suppressed)" % (record.msg, suppressed)
+        return True
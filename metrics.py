@@ -0,0 +1,229 @@
+"""
+Performance instrumentation: rolling histograms, counters, gauges and per-frame traces, with exporters.
+
+Every stage of the game records into the module level `registry`.
+
+@author: Jeroen Vlek <j.vlek@anchormen.nl>
+"""
+
+import collections
+import contextlib
+import cProfile
+import http.server
+import io
+import json
+import logging
+import pstats
+import threading
+import time
+
+import numpy as np
+
+from constants import METRICS_WINDOW, MAX_TRACED_FRAMES
+
+# Stages a frame goes through, in order, as recorded by Metrics.trace
+TRACE_STAGES = ('capture', 'inference', 'applied', 'displayed')
+
+
+class Histogram(object):
+    """
+    Keeps the last `window` samples, plus the count and sum of all samples ever observed
+    """
+
+    def __init__(self, window=METRICS_WINDOW):
+        self.samples = collections.deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def summary(self):
+        summary = {"count": self.count, "sum": self.total}
+        if self.samples:
+            samples = np.fromiter(self.samples, dtype=np.float64, count=len(self.samples))
+            p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+            summary.update({"mean": float(samples.mean()), "p50": float(p50), "p90": float(p90),
+                            "p99": float(p99), "max": float(samples.max())})
+
+        return summary
+
+
+class Metrics(object):
+    """
+    Registry of named histograms, counters and gauges. Gauges may be callables, which are evaluated when exported.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = collections.defaultdict(Histogram)
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.traces = collections.OrderedDict()
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms[name].observe(value)
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """
+        Observes the duration of the with block, in seconds
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def trace(self, seq, stage, timestamp=None):
+        """
+        Records when frame `seq` reached one of the TRACE_STAGES. Once it's displayed, the time it took from capture
+        to every later stage is observed as latency.<stage>.
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        with self.lock:
+            stages = self.traces.get(seq)
+            if stages is None:
+                stages = self.traces[seq] = {}
+                if len(self.traces) > MAX_TRACED_FRAMES:
+                    self.traces.popitem(last=False)
+            stages.setdefault(stage, timestamp)
+
+            if stage == TRACE_STAGES[-1] and TRACE_STAGES[0] in stages:
+                captured = stages[TRACE_STAGES[0]]
+                for later_stage in TRACE_STAGES[1:]:
+                    if later_stage in stages:
+                        self.histograms["latency." + later_stage].observe(stages[later_stage] - captured)
+
+    def snapshot(self):
+        with self.lock:
+            gauges = dict((name, value() if callable(value) else value) for name, value in self.gauges.items())
+            return {"timestamp": time.time(),
+                    "histograms": dict((name, histogram.summary()) for name, histogram in self.histograms.items()),
+                    "counters": dict(self.counters),
+                    "gauges": gauges}
+
+    def prometheus_text(self, prefix="poselogoslap_"):
+        """
+        Renders a snapshot in the Prometheus text exposition format, histograms become summaries
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric_name(name):
+            return prefix + name.replace('.', '_').replace('-', '_')
+
+        for name, summary in sorted(snapshot["histograms"].items()):
+            name = metric_name(name)
+            lines.append("# TYPE %s summary" % name)
+            for key, quantile in (("p50", "0.5"), ("p90", "0.9"), ("p99", "0.99")):
+                if key in summary:
+                    lines.append('%s{quantile="%s"} %r' % (name, quantile, summary[key]))
+            lines.append("%s_sum %r" % (name, summary["sum"]))
+            lines.append("%s_count %d" % (name, summary["count"]))
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append("# TYPE %s counter" % metric_name(name))
+            lines.append("%s %r" % (metric_name(name), value))
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append("# TYPE %s gauge" % metric_name(name))
+            lines.append("%s %r" % (metric_name(name), value))
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Metrics()
+
+
+class JsonLinesExporter(threading.Thread):
+    """
+    Appends a snapshot of the metrics to a file as a JSON line, every `interval` seconds
+    """
+
+    def __init__(self, path, interval, metrics=registry):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.metrics = metrics
+        self.stopped = threading.Event()
+
+    def run(self):
+        with open(self.path, 'a') as output:
+            while not self.stopped.wait(self.interval):
+                output.write(json.dumps(self.metrics.snapshot()) + "\n")
+                output.flush()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class PrometheusExporter(threading.Thread):
+    """
+    Serves the metrics in the Prometheus text format on http://localhost:<port>/metrics
+    """
+
+    def __init__(self, port, metrics=registry):
+        super().__init__(daemon=True)
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = metrics.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.HTTPServer(("127.0.0.1", port), Handler)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class Profiler(object):
+    """
+    Starts and stops cProfile captures, dumping each to a .prof file
+    """
+
+    def __init__(self, path_template="profile-%d.prof"):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.path_template = path_template
+        self.profile = None
+
+    def toggle(self):
+        if self.profile is None:
+            self.logger.info("Starting profile capture")
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            return
+
+        self.profile.disable()
+        path = self.path_template % int(time.time())
+        self.profile.dump_stats(path)
+
+        summary = io.StringIO()
+        pstats.Stats(self.profile, stream=summary).sort_stats("cumulative").print_stats(15)
+        self.logger.info("Profile written to %s\n%s", path, summary.getvalue())
+        self.profile = None
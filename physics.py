@@ -0,0 +1,222 @@
+"""
+The physics world of the game, and keeping its simulation in step with the wall clock.
+
+@author: Jeroen Vlek <j.vlek@anchormen.nl>
+"""
+
+import random
+
+import numpy as np
+import pygame
+import pymunk
+
+from constants import *
+from entities import GoalPost, Logo, PushBodyPool, Score
+
+
+def body_state(body):
+    """
+    Position, velocity, angle and angular velocity of a body
+    """
+    return body.position, body.velocity, body.angle, body.angular_velocity
+
+
+def set_body_state(body, state):
+    body.position, body.velocity, body.angle, body.angular_velocity = state
+    if body.space:
+        body.space.reindex_shapes_for_body(body)
+
+
+class WorldSnapshot(object):
+    """
+    The state of a World at one moment: that of the logo and of the push bodies in use, and the scores
+    """
+
+    def __init__(self, logo, push_bodies, scores):
+        self.logo = logo
+        self.push_bodies = push_bodies
+        self.scores = scores
+
+
+class World(object):
+    """
+    Everything in the game that takes part in the physics: the screen bounds, the goals, the logo and the push bodies.
+
+    Doesn't need a display, so it also runs headless. The score counters can be anything with the interface of Score;
+    the left goal counts towards `right_score` and vice versa.
+
+    In crowd mode, for `crowd_players` players, the space indexes its shapes in a spatial hash and only the push bodies
+    near the logo collide.
+    """
+
+    culled = pymunk.ShapeFilter(categories=0, mask=0)
+
+    def __init__(self, screen_dims, left_score=None, right_score=None, pool_size=PUSH_BODY_POOL_SIZE,
+                 crowd_players=None):
+        self.screen_dims = screen_dims
+        self.space = pymunk.Space()
+        self.space.damping = DAMPING
+        self.space.add_collision_handler(COLLTYPE_LOGO, COLLTYPE_GOAL).separate = GoalPost.goal_scored_handler
+
+        self.add_screen_bounds()
+        self.add_goals(left_score if left_score else Score(), right_score if right_score else Score())
+        self.logo_box = None
+
+        self.crowd_mode = False
+        self.cull_distance = CROWD_CULL_DISTANCE
+        self.regions = CROWD_REGIONS
+        self.hands_per_region = CROWD_HANDS_PER_REGION
+        self.culled_count = 0
+        if crowd_players:
+            self.enable_crowd_mode(crowd_players)
+        self.push_bodies = PushBodyPool(self.space, pool_size, limit_per_step=not self.crowd_mode)
+
+    def add_screen_bounds(self):
+        # Setup bounding box around the screen, the lines start in the top left and go clockwise
+        width, height = self.screen_dims
+        static_body = self.space.static_body
+        static_lines = [pymunk.Segment(static_body, (0, 0), (width, 0), 0.0),
+                        pymunk.Segment(static_body, (width, 0), (width, height), 0.0),
+                        pymunk.Segment(static_body, (width, height), (0, height), 0.0),
+                        pymunk.Segment(static_body, (0, height), (0, 0), 0.0)]
+        for line in static_lines:
+            line.elasticity = 0.95
+            line.friction = 0.9
+        self.space.add(static_lines)
+
+    def add_goals(self, left_score, right_score):
+        width, height = self.screen_dims
+        static_body = self.space.static_body
+        goal_length = height * RELATIVE_GOAL_SIZE
+        self.left_goal = GoalPost(static_body, (GOAL_MARGIN, (height / 2 - goal_length / 2)),
+                                  (GOAL_MARGIN, (height / 2 + goal_length / 2)), GOAL_MARGIN, right_score)
+        self.right_goal = GoalPost(static_body, (width - GOAL_MARGIN, (height / 2 - goal_length / 2)),
+                                   (width - GOAL_MARGIN, (height / 2 + goal_length / 2)), GOAL_MARGIN, left_score)
+        self.space.add([self.left_goal, self.right_goal])
+
+    def spawn_logo(self, rng=random):
+        """
+        Puts the logo somewhere in the middle half of the screen, standing still. The box is only created the first
+        time, after that it's moved in place. Returns the box.
+        """
+        mid_point = (self.screen_dims[0] / 2, self.screen_dims[1] / 2)
+        quarter_screen_dims = (mid_point[0] / 2, mid_point[1] / 2)
+        x = rng.randint(int(mid_point[0] - quarter_screen_dims[0]), int(mid_point[0] + quarter_screen_dims[0]))
+        y = rng.randint(int(mid_point[1] - quarter_screen_dims[1]), int(mid_point[1] + quarter_screen_dims[1]))
+
+        if self.logo_box:
+            set_body_state(self.logo_box.body, ((x, y), (0, 0), 0.0, 0.0))
+            return self.logo_box
+
+        rect = pygame.Rect((0, 0), LOGO_SIZE)
+        rect.center = (x, y)
+        self.logo_box = Logo.create_logo_box(rect)
+        self.space.add(self.logo_box.body, self.logo_box)
+        return self.logo_box
+
+    def enable_crowd_mode(self, num_players, cull_distance=CROWD_CULL_DISTANCE, regions=CROWD_REGIONS,
+                          hands_per_region=CROWD_HANDS_PER_REGION):
+        """
+        Switches the space to a spatial hash sized for the hands of `num_players` players, and starts culling the
+        push bodies: see cull_push_bodies. Has to happen before the push bodies are created, which limit their
+        velocities when they move from then on.
+        """
+        num_bodies = 2 * num_players + 1
+        self.space.use_spatial_hash(CROWD_HASH_CELL_SIZE, CROWD_HASH_COUNT_PER_BODY * num_bodies)
+        self.crowd_mode = True
+        self.cull_distance = cull_distance
+        self.regions = regions
+        self.hands_per_region = hands_per_region
+
+    def cull_push_bodies(self):
+        """
+        Takes the push bodies that can't reach the logo soon out of the collision detection, like parked ones. Of the
+        rest, only the `hands_per_region` nearest to the logo collide in each of `regions` vertical strips of the
+        screen. Meant to be called once per frame, before stepping the space.
+        """
+        push_bodies = self.push_bodies.in_use
+        if not push_bodies or not self.logo_box:
+            self.culled_count = 0
+            return
+
+        positions = np.array([tuple(push_body.body.position) for push_body in push_bodies])
+        logo_x, logo_y = self.logo_box.body.position
+        distances = np.hypot(positions[:, 0] - logo_x, positions[:, 1] - logo_y)
+        colliding = distances <= self.cull_distance
+
+        if self.hands_per_region:
+            region_width = self.screen_dims[0] / float(self.regions)
+            regions = np.clip((positions[:, 0] // region_width).astype(int), 0, self.regions - 1)
+            # Rank the bodies within their region by distance, culled ones last
+            order = np.lexsort((distances, ~colliding, regions))
+            sorted_regions = regions[order]
+            ranks = np.empty(len(order), dtype=int)
+            ranks[order] = np.arange(len(order)) - np.searchsorted(sorted_regions, sorted_regions)
+            colliding &= ranks < self.hands_per_region
+
+        for push_body, collides in zip(push_bodies, colliding):
+            shape_filter = pymunk.ShapeFilter() if collides else World.culled
+            if push_body.shape.filter != shape_filter:
+                push_body.shape.filter = shape_filter
+        self.culled_count = len(push_bodies) - int(np.count_nonzero(colliding))
+
+    def snapshot(self):
+        """
+        Returns the current state, to go back to with restore
+        """
+        logo = body_state(self.logo_box.body) if self.logo_box else None
+        push_bodies = [(push_body, body_state(push_body.body)) for push_body in self.push_bodies.in_use]
+        return WorldSnapshot(logo, push_bodies, (self.left_goal.counter.score, self.right_goal.counter.score))
+
+    def restore(self, snapshot):
+        """
+        Goes back to the state of `snapshot` in place: nothing is added to or removed from the space. Push bodies
+        that were released since aren't brought back, and those acquired since are left to their owners.
+        """
+        if self.logo_box and snapshot.logo:
+            set_body_state(self.logo_box.body, snapshot.logo)
+
+        in_use = set(self.push_bodies.in_use)
+        for push_body, state in snapshot.push_bodies:
+            if push_body in in_use:
+                set_body_state(push_body.body, state)
+
+        for goal, score in zip((self.left_goal, self.right_goal), snapshot.scores):
+            if goal.counter.score != score:
+                goal.counter.set_score(score)
+
+
+class FixedTimestep(object):
+    """
+    Accumulates elapsed wall time and pays it out in fixed physics steps of `dt` seconds.
+
+    What's left over is carried to the next frame and tells how far rendering is between the last two physics states.
+    At most `max_steps` steps are taken per frame, time beyond that is dropped, so a slow frame can't snowball into
+    ever slower frames.
+    """
+
+    def __init__(self, dt=DT, max_steps=MAX_PHYSICS_STEPS_PER_FRAME):
+        self.dt = dt
+        self.max_steps = max_steps
+        self.accumulator = 0.0
+        self.dropped_time = 0.0
+
+    def advance(self, elapsed):
+        """
+        Adds `elapsed` seconds and returns the number of physics steps to take for it
+        """
+        self.accumulator += elapsed
+        steps = int(self.accumulator / self.dt)
+        if steps > self.max_steps:
+            self.dropped_time += (steps - self.max_steps) * self.dt
+            steps = self.max_steps
+            self.accumulator = self.max_steps * self.dt
+
+        self.accumulator -= steps * self.dt
+        return steps
+
+    def alpha(self):
+        """
+        Fraction of a step the wall clock is ahead of the last physics state, to interpolate rendering with
+        """
+        return self.accumulator / self.dt
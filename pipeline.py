@@ -0,0 +1,646 @@
+"""
+Runs capture and pose estimation in processes of their own, so they don't compete with the game loop for the GIL.
+
+Frames and poses are handed over through rings of preallocated shared memory slots, nothing is pickled per frame.
+
+@author: Jeroen Vlek <j.vlek@anchormen.nl>
+"""
+
+import collections
+import contextlib
+import ctypes
+import logging
+import multiprocessing
+import multiprocessing.sharedctypes
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from camera import CapturedFrame, create_frame_source
+from constants import CAMERA_FOURCC, FAILED_READ_BACKOFF, INFERENCE_POOL_MAX_WAIT, MAX_FRAME_AGE, MAX_SHARED_POSES, \
+    NUM_KEY_POINTS, RING_POLL_INTERVAL, SHARED_RING_SLOTS
+from inference import InferenceScheduler, PoseResult, ResultSlot
+from logs import RateLimitFilter
+from metrics import registry
+from pose_estimator import PoseEstimator, RegionOfInterest, create_backend
+
+
+class SharedRing(object):
+    """
+    A fixed number of record slots in shared memory, written by a single process and read by any number of others.
+
+    A record is a sequence number, a timestamp and one array per field. The writer fills the slots round robin, in
+    place, and publishes the sequence number of the newest complete record. Readers copy that record into their own
+    buffers and check its slot's sequence number before and after, so a record that gets overwritten while being
+    copied is never handed out. A reader stores the newest sequence number it took, for a writer that needs to know
+    whether its single reader is keeping up.
+    """
+
+    def __init__(self, fields, slots=SHARED_RING_SLOTS):
+        self.fields = collections.OrderedDict((name, (tuple(shape), np.dtype(dtype))) for name, shape, dtype in fields)
+        self.slots = slots
+        self.buffers = dict((name, multiprocessing.sharedctypes.RawArray(ctypes.c_uint8, slots * int(np.prod(shape)) *
+                                                                         dtype.itemsize))
+                            for name, (shape, dtype) in self.fields.items())
+        self.slot_seqs = multiprocessing.sharedctypes.RawArray(ctypes.c_int64, slots)
+        self.slot_timestamps = multiprocessing.sharedctypes.RawArray(ctypes.c_double, slots)
+        self.head = multiprocessing.sharedctypes.RawValue(ctypes.c_int64, 0)
+        self.head_slot = multiprocessing.sharedctypes.RawValue(ctypes.c_int64, 0)
+        self.consumed = multiprocessing.sharedctypes.RawValue(ctypes.c_int64, 0)
+        self._map()
+
+    def _map(self):
+        self.views = dict((name, np.frombuffer(self.buffers[name], dtype=dtype).reshape((self.slots,) + shape))
+                          for name, (shape, dtype) in self.fields.items())
+        self.seqs = np.frombuffer(self.slot_seqs, dtype=np.int64)
+        self.timestamps = np.frombuffer(self.slot_timestamps, dtype=np.float64)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('views', 'seqs', 'timestamps'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._map()
+
+    def allocate(self):
+        """
+        Returns a set of private arrays to read records into
+        """
+        return dict((name, np.empty(shape, dtype)) for name, (shape, dtype) in self.fields.items())
+
+    @contextlib.contextmanager
+    def writing(self, timestamp, seq=None):
+        """
+        Yields the arrays of the next slot to fill in, and publishes them as record `seq` afterwards. Sequence numbers
+        have to increase, by default they count up from the previous record.
+        """
+        if seq is None:
+            seq = self.head.value + 1
+
+        slot = (self.head_slot.value + 1) % self.slots
+        self.seqs[slot] = -1
+        yield dict((name, view[slot]) for name, view in self.views.items())
+        self.timestamps[slot] = timestamp
+        self.seqs[slot] = seq
+        self.head_slot.value = slot
+        self.head.value = seq
+
+    def read(self, after_seq, out):
+        """
+        Copies the newest record into the `out` arrays if it's newer than `after_seq`. Returns its sequence number and
+        timestamp, or None if there is nothing new or it was overwritten while copying.
+        """
+        seq = self.head.value
+        if seq <= after_seq:
+            return None
+
+        slot = self.head_slot.value
+        if self.seqs[slot] != seq:
+            return None
+
+        timestamp = float(self.timestamps[slot])
+        for name, array in out.items():
+            np.copyto(array, self.views[name][slot])
+
+        if self.seqs[slot] != seq:
+            return None
+
+        return seq, timestamp
+
+
+class RingReader(object):
+    """
+    Reads the newest records of a ring into two alternating sets of buffers, so the previous record stays intact while
+    the next one is copied.
+    """
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.buffers = [ring.allocate(), ring.allocate()]
+        self.current = 0
+        self.seq = 0
+        self.received = 0
+        self.skipped = 0
+
+    def pop(self):
+        """
+        Returns the sequence number, timestamp and arrays of the newest record, or None if there is nothing new
+        """
+        out = self.buffers[1 - self.current]
+        record = self.ring.read(self.seq, out)
+        if record is None:
+            return None
+
+        seq, timestamp = record
+        if self.seq:
+            self.skipped += seq - self.seq - 1
+        self.seq = seq
+        self.ring.consumed.value = seq
+        self.received += 1
+        self.current = 1 - self.current
+        return seq, timestamp, out
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            record = self.pop()
+            if record is not None or time.monotonic() >= deadline:
+                return record
+            time.sleep(RING_POLL_INTERVAL)
+
+
+class SharedFrameSource(object):
+    """
+    Stands in for a FrameGrabber, handing out the frames the capture process writes to a ring
+    """
+
+    def __init__(self, ring, max_frame_age=MAX_FRAME_AGE):
+        self.reader = RingReader(ring)
+        self.max_frame_age = max_frame_age
+        self.recorder = None
+        self.stale = 0
+
+    def _frame(self, record):
+        if record is None:
+            return None
+
+        seq, timestamp, arrays = record
+        if self.max_frame_age is not None and time.monotonic() - timestamp > self.max_frame_age:
+            self.stale += 1
+            return None
+
+        registry.trace(seq, "capture", timestamp)
+        return CapturedFrame(seq, timestamp, arrays["image"], arrays.get("inference_image"))
+
+    def pop_frame(self):
+        return self._frame(self.reader.pop())
+
+    def wait_for_frame(self, timeout=None):
+        return self._frame(self.reader.wait(timeout if timeout is not None else float('inf')))
+
+
+class SharedInference(object):
+    """
+    Stands in for an InferenceWorker, handing out the results the inference process writes to a ring
+    """
+
+    def __init__(self, ring):
+        self.reader = RingReader(ring)
+
+    def pop_result(self):
+        record = self.reader.pop()
+        if record is None:
+            return None
+
+        seq, timestamp, arrays = record
+        num_poses = int(arrays["num_poses"][0])
+        if num_poses < 0:
+            # A frame the estimator skipped, shown with the poses found before
+            return PoseResult(seq, timestamp, None, arrays["output_frame"], None)
+
+        latency = float(arrays["latency"][0])
+        registry.observe("inference", latency)
+        registry.trace(seq, "capture", timestamp)
+        registry.trace(seq, "inference", float(arrays["completed"][0]))
+
+        key_points = arrays["key_points"][:num_poses]
+        return PoseResult(seq, timestamp, key_points, arrays["output_frame"], latency)
+
+    def stop(self):
+        pass
+
+
+def frame_fields(width, height, inference_size=None):
+    fields = [("image", (height, width, 3), np.uint8)]
+    if inference_size:
+        fields.append(("inference_image", (inference_size[1], inference_size[0], 3), np.uint8))
+    return fields
+
+
+def result_fields(width, height):
+    return [("key_points", (MAX_SHARED_POSES, NUM_KEY_POINTS, 3), np.float32),
+            ("num_poses", (1,), np.int64),
+            ("latency", (1,), np.float64),
+            ("completed", (1,), np.float64),
+            ("output_frame", (height, width, 3), np.uint8)]
+
+
+def run_capture(ring, width, height, source, fps, inference_size, stopped, fourcc=CAMERA_FOURCC, real_time=True):
+    """
+    Body of the capture process: flips the frames of a source, given as a spec for create_frame_source, straight into
+    the ring's slots
+    """
+    logger = logging.getLogger("CaptureProcess")
+    logger.info("Starting capture process")
+    capture = create_frame_source(source, width, height, fps, fourcc, real_time)
+
+    while not stopped.is_set():
+        success, frame = capture.read()
+        if not success:
+            time.sleep(FAILED_READ_BACKOFF)
+            continue
+
+        timestamp = time.monotonic()
+        if frame.shape[0:2] != (height, width):
+            frame = cv2.resize(frame, (width, height))
+
+        with ring.writing(timestamp) as slot:
+            cv2.flip(frame, 1, dst=slot["image"])
+            if inference_size:
+                cv2.resize(slot["image"], inference_size, dst=slot["inference_image"], interpolation=cv2.INTER_AREA)
+
+    capture.release()
+    logger.info("Captured %d frames at %.1f fps", ring.head.value, capture.throughput())
+
+
+def run_inference(frame_ring, result_ring, backend_args, roi, max_frame_age, scheduler_args, stopped, status=None):
+    """
+    Body of the inference process: estimates the poses in the newest frame and writes them to the result ring. Given
+    the arguments of an InferenceScheduler, it adapts to a latency budget. Frames it skips are written without poses,
+    with `num_poses` -1, like the InferenceWorker publishes them. Given a shared `status` array, it stores the
+    sequence number of the last frame it's done with, whether it wrote a result for it or not, the total number of
+    seconds spent estimating and, once the backend is loaded, a 1.
+    """
+    logger = logging.getLogger("InferenceProcess")
+    # Warns for every frame while the crowd is too large
+    logger.addFilter(RateLimitFilter(level=logging.WARNING))
+    logger.info("Starting inference process")
+    pose_estimator = PoseEstimator(create_backend(**backend_args), RegionOfInterest() if roi else None)
+    scheduler = InferenceScheduler(pose_estimator, **scheduler_args) if scheduler_args is not None else None
+    frames = SharedFrameSource(frame_ring, max_frame_age)
+    if status is not None:
+        status[2] = 1
+
+    # The last frame poses were written for, and whether skipped frames look the same as estimated ones
+    last_estimated = 0
+    show_skipped = True
+    estimated = skipped = 0
+    while not stopped.is_set():
+        frame = frames.wait_for_frame(timeout=0.1)
+        if frame is None:
+            continue
+        if scheduler and not scheduler.ready(time.monotonic()):
+            # Unless it would replace poses that weren't taken yet
+            if show_skipped and result_ring.consumed.value >= last_estimated:
+                with result_ring.writing(frame.timestamp, frame.seq) as slot:
+                    slot["num_poses"][0] = -1
+                    np.copyto(slot["output_frame"], frame.image)
+            if status is not None:
+                status[0] = frame.seq
+            skipped += 1
+            continue
+
+        start = time.monotonic()
+        estimate = scheduler.estimate(frame) if scheduler else pose_estimator.estimate(frame)
+        completed = time.monotonic()
+
+        key_points = estimate.key_points
+        if len(key_points) > MAX_SHARED_POSES:
+            logger.warning("Found %d poses, only passing on %d", len(key_points), MAX_SHARED_POSES)
+            key_points = key_points[:MAX_SHARED_POSES]
+
+        with result_ring.writing(frame.timestamp, frame.seq) as slot:
+            slot["key_points"][:len(key_points)] = key_points
+            slot["num_poses"][0] = len(key_points)
+            slot["latency"][0] = completed - start
+            slot["completed"][0] = completed
+            np.copyto(slot["output_frame"], estimate.output_frame)
+        last_estimated = frame.seq
+        estimated += 1
+        show_skipped = estimate.output_frame is frame.image or not len(key_points)
+
+        if status is not None:
+            status[1] += completed - start
+            status[0] = frame.seq
+
+    # In a pool the dispatcher decides which frames a worker sees, so only count the ones the scheduler skipped
+    logger.info("Estimated %d frames, the scheduler skipped %d", estimated, skipped)
+
+
+class ProcessPipeline(object):
+    """
+    Starts a capture process and, given the arguments of `create_backend`, an inference process, which is scheduled
+    adaptively given the arguments of an InferenceScheduler. `frames` and `inference` take the place of the
+    FrameGrabber and InferenceWorker in the game. Until the inference process has loaded its model, the game can show
+    the frames itself.
+    """
+
+    def __init__(self, width, height, source=0, fps=30, inference_size=None, backend_args=None, roi=False,
+                 max_frame_age=MAX_FRAME_AGE, scheduler_args=None, fourcc=CAMERA_FOURCC, real_time=True):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        context = multiprocessing.get_context("spawn")
+        self.stopped = context.Event()
+
+        frame_ring = SharedRing(frame_fields(width, height, inference_size))
+        self.frame_ring = frame_ring
+        self.frames = SharedFrameSource(frame_ring, max_frame_age)
+        self.processes = [context.Process(target=run_capture, name="capture", daemon=True,
+                                          args=(frame_ring, width, height, source, fps, inference_size,
+                                                self.stopped, fourcc, real_time))]
+
+        self.inference = None
+        self.status = multiprocessing.sharedctypes.RawArray(ctypes.c_double, 3)
+        if backend_args is not None:
+            result_ring = SharedRing(result_fields(width, height))
+            self.inference = SharedInference(result_ring)
+            self.processes.append(context.Process(target=run_inference, name="inference", daemon=True,
+                                                  args=(frame_ring, result_ring, backend_args, roi, max_frame_age,
+                                                        scheduler_args, self.stopped, self.status)))
+
+        registry.set_gauge("capture.captured", lambda: frame_ring.head.value)
+        registry.set_gauge("capture.stale", lambda: self.frames.stale)
+        if self.inference:
+            registry.set_gauge("inference.received", lambda: self.inference.reader.received)
+            registry.set_gauge("inference.skipped", lambda: self.inference.reader.skipped)
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def wait_until_capturing(self):
+        """
+        Waits for the first frame. Returns whether it came, or False when stopped first, raises if capture died.
+        """
+        return self._wait(lambda: self.frame_ring.head.value > 0, self.processes[0])
+
+    def wait_until_ready(self, timeout=None):
+        """
+        Waits until the inference process has loaded its model. Returns whether it happened, raises if it died.
+        """
+        return self._wait(lambda: self.status[2], self.processes[1], timeout)
+
+    def _wait(self, condition, process, timeout=None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while not condition():
+            if not process.is_alive():
+                raise Exception("The %s process died while starting, exit code %s" % (process.name, process.exitcode))
+            if self.stopped.is_set() or deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stop(self, timeout=2.0):
+        self.logger.info("Stopping %d processes", len(self.processes))
+        self.stopped.set()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                self.logger.warning("Terminating %s process", process.name)
+                process.terminate()
+
+
+class ReorderBuffer(object):
+    """
+    Puts the results of frames that are estimated side by side back in frame order.
+
+    Every dispatched frame gets a place in line, which its result or its abandonment clears. A result that's stuck
+    behind an older frame for more than `max_wait` seconds jumps the line, and the older frames' results are dropped
+    as stale when they come in after all.
+    """
+
+    def __init__(self, max_wait=INFERENCE_POOL_MAX_WAIT):
+        self.max_wait = max_wait
+        self.pending = collections.deque()
+        self.results = {}
+        self.arrivals = {}
+        self.abandoned_seqs = set()
+        self.last_seq = 0
+        self.stale = 0
+
+    def dispatched(self, seq):
+        self.pending.append(seq)
+
+    def completed(self, result, now):
+        if result.seq <= self.last_seq:
+            self.stale += 1
+            return
+
+        self.results[result.seq] = result
+        self.arrivals[result.seq] = now
+
+    def abandoned(self, seq):
+        if seq > self.last_seq:
+            self.abandoned_seqs.add(seq)
+
+    def pop(self, now):
+        """
+        Returns the results that are next in line, oldest first
+        """
+        if self.results and self.pending and self.pending[0] not in self.results and \
+                self.pending[0] not in self.abandoned_seqs:
+            waited = [seq for seq, arrival in self.arrivals.items() if now - arrival > self.max_wait]
+            if waited:
+                # Give up on everything before the oldest result that's waited long enough
+                cutoff = min(waited)
+                while self.pending[0] < cutoff:
+                    self.abandoned_seqs.discard(self.pending.popleft())
+
+        ready = []
+        while self.pending:
+            seq = self.pending[0]
+            if seq in self.results:
+                ready.append(self.results.pop(seq))
+                del self.arrivals[seq]
+            elif seq in self.abandoned_seqs:
+                self.abandoned_seqs.discard(seq)
+            else:
+                break
+            self.pending.popleft()
+            self.last_seq = seq
+
+        return ready
+
+
+def run_pool_worker(threads, *args):
+    """
+    Body of an inference pool process: run_inference, with the threads of the numerical libraries limited to its share
+    of the cores. The backend loads them lazily, so it's not too late to set.
+    """
+    for variable in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[variable] = str(threads)
+    cv2.setNumThreads(threads)
+    run_inference(*args)
+
+
+class InferencePool(object):
+    """
+    Runs `workers` pose estimators in processes of their own, given the arguments of `create_backend`, to make use of
+    all cores of a machine without a GPU. Takes the place of the InferenceWorker in the game.
+
+    Once a worker has loaded its model, a dispatcher thread hands the frames of the frame grabber to the next idle
+    worker, round robin, and drops them if all workers are busy. A collector thread puts the results back in frame
+    order before publishing them. Throughput and every worker's utilisation are exported as gauges.
+    """
+
+    def __init__(self, frame_grabber, workers, width, height, inference_size=None, backend_args=None, roi=False,
+                 scheduler_args=None, max_wait=INFERENCE_POOL_MAX_WAIT):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.frame_grabber = frame_grabber
+        context = multiprocessing.get_context("spawn")
+        self.stopped = context.Event()
+        threads = max(1, multiprocessing.cpu_count() // workers)
+
+        self.frame_rings = []
+        self.readers = []
+        self.statuses = []
+        self.processes = []
+        for worker in range(workers):
+            frame_ring = SharedRing(frame_fields(width, height, inference_size))
+            result_ring = SharedRing(result_fields(width, height))
+            status = multiprocessing.sharedctypes.RawArray(ctypes.c_double, 3)
+            # Frames are handed out fresh, so the workers don't need to check their age
+            self.processes.append(context.Process(target=run_pool_worker, name="inference-%d" % worker, daemon=True,
+                                                  args=(threads, frame_ring, result_ring, backend_args, roi, None,
+                                                        scheduler_args, self.stopped, status)))
+            self.frame_rings.append(frame_ring)
+            self.readers.append(SharedInference(result_ring))
+            self.statuses.append(status)
+
+        self.lock = threading.Lock()
+        self.in_flight = [None] * workers
+        self.next_worker = 0
+        self.reorder = ReorderBuffer(max_wait)
+        self.results = ResultSlot()
+        self.dispatched = 0
+        self.dropped = 0
+        self.started = None
+        self.running = False
+        self.ready = threading.Event()
+        self.threads = [threading.Thread(target=self.dispatch, name="InferencePoolDispatcher", daemon=True),
+                        threading.Thread(target=self.collect, name="InferencePoolCollector", daemon=True)]
+
+        registry.set_gauge("inference.pool.throughput", self.throughput)
+        registry.set_gauge("inference.pool.dropped", lambda: self.dropped)
+        registry.set_gauge("inference.pool.stale", lambda: self.reorder.stale)
+        for worker in range(workers):
+            registry.set_gauge("inference.pool.worker%d.utilisation" % worker,
+                               lambda worker=worker: self.utilisation(worker))
+
+    def start(self):
+        self.started = time.monotonic()
+        self.running = True
+        for process in self.processes:
+            process.start()
+        for thread in self.threads:
+            thread.start()
+
+    def dispatch(self):
+        # Leave the frames to the game until a worker is ready for them
+        while self.running and not any(status[2] for status in self.statuses):
+            time.sleep(0.01)
+        self.ready.set()
+
+        while self.running:
+            frame = self.frame_grabber.wait_for_frame(timeout=0.1)
+            if frame is None:
+                continue
+
+            with self.lock:
+                worker = self.idle_worker()
+                if worker is None:
+                    self.dropped += 1
+                    continue
+                self.in_flight[worker] = frame.seq
+                self.reorder.dispatched(frame.seq)
+
+            with self.frame_rings[worker].writing(frame.timestamp, frame.seq) as slot:
+                np.copyto(slot["image"], frame.image)
+                if frame.inference_image is not None:
+                    np.copyto(slot["inference_image"], frame.inference_image)
+            self.dispatched += 1
+
+    def idle_worker(self):
+        """
+        Returns the next worker in line that isn't busy, or None if they all are
+        """
+        workers = len(self.in_flight)
+        for offset in range(workers):
+            worker = (self.next_worker + offset) % workers
+            if self.in_flight[worker] is None:
+                self.next_worker = (worker + 1) % workers
+                return worker
+        return None
+
+    def collect(self):
+        while self.running:
+            now = time.monotonic()
+            with self.lock:
+                for worker, reader in enumerate(self.readers):
+                    seq = self.in_flight[worker]
+                    if seq is None:
+                        continue
+
+                    # A worker stores what it's done with after writing the result, so check that first
+                    done = self.statuses[worker][0] >= seq
+                    result = reader.pop_result()
+                    if result is not None:
+                        # The reader reuses its buffers, while the reorder buffer may hold on to a result for a while
+                        key_points = result.key_points.copy() if result.key_points is not None else None
+                        self.reorder.completed(result._replace(key_points=key_points,
+                                                               output_frame=result.output_frame.copy()), now)
+                    if done:
+                        if result is None or result.seq != seq:
+                            self.reorder.abandoned(seq)
+                        self.in_flight[worker] = None
+
+                ready = self.reorder.pop(now)
+
+            for result in ready:
+                self.results.publish(result)
+            time.sleep(RING_POLL_INTERVAL)
+
+    def wait_until_ready(self, timeout=None):
+        """
+        Waits until one of the workers has loaded its model. Returns whether it happened, raises if all workers died.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while not self.ready.wait(0.1):
+            if not any(process.is_alive() for process in self.processes):
+                raise Exception("All inference pool workers died while loading, exit codes %s" %
+                                ", ".join(str(process.exitcode) for process in self.processes))
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+        return True
+
+    def throughput(self):
+        """
+        Results published per second since the start
+        """
+        if not self.started:
+            return 0.0
+        return self.results.published / max(time.monotonic() - self.started, 1e-6)
+
+    def utilisation(self, worker):
+        """
+        Fraction of the time since the start that the worker spent estimating
+        """
+        if not self.started:
+            return 0.0
+        return self.statuses[worker][1] / max(time.monotonic() - self.started, 1e-6)
+
+    def pop_result(self):
+        """
+        Returns the newest PoseResult, or None if there is nothing new since the last call.
+        """
+        return self.results.consume()
+
+    def stop(self, timeout=2.0):
+        self.logger.info("Published %d results at %.1f per second, dropped %d frames and %d stale results. "
+                         "Utilisation per worker: %s", self.results.published, self.throughput(), self.dropped,
+                         self.reorder.stale,
+                         ", ".join("%.0f%%" % (100 * self.utilisation(worker)) for worker in range(len(self.statuses))))
+        self.running = False
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                self.logger.warning("Terminating %s process", process.name)
+                process.terminate()
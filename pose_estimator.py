@@ -1,28 +1,383 @@
 """
+Pose estimation with interchangeable backends. Every backend returns key points shaped like OpenPose's
+`datum.poseKeypoints`: N x 25 x 3, with x, y and confidence per BODY_25 key point.
 
 @author: Jeroen Vlek <j.vlek@anchormen.nl>
 """
 
-from openpose import pyopenpose
+import collections
+import logging
+import math
+import os
+import time
 
+import cv2
+import numpy as np
+
+from constants import *
+
+PoseEstimate = collections.namedtuple('PoseEstimate', ['key_points', 'output_frame'])
+
+BACKENDS = ('openpose', 'opencv', 'synthetic', 'replay')
+
+
+def empty_key_points():
+    return np.zeros((0, NUM_KEY_POINTS, 3), dtype=np.float32)
+
+
+def parse_net_resolution(net_resolution, width, height):
+    """
+    Turns an OpenPose net resolution like "-1x368" into the (width, height) of the network input for a frame of the
+    given size. A -1 means it is derived from the aspect ratio, rounded to a multiple of 16 like OpenPose does.
+    """
+    net_width, net_height = (int(value) for value in net_resolution.split('x'))
+    if net_width < 0:
+        net_width = int(round(net_height * width / height / 16.0)) * 16
+    if net_height < 0:
+        net_height = int(round(net_width * height / width / 16.0)) * 16
+
+    return net_width, net_height
+
+
+class PoseBackend(object):
+    """
+    Interface of a pose backend
+    """
+
+    def estimate(self, frame):
+        """
+        Estimates the poses in a BGR frame. Returns an N x 25 x 3 key point array and a frame with the poses rendered
+        onto it, or None if the backend doesn't render.
+        """
+        raise NotImplementedError
+
+    def set_net_resolution(self, net_resolution):
+        """
+        Switches to another net resolution, if the backend can do so on the fly. Returns whether it did.
+        """
+        return False
+
+
+class OpenPoseBackend(PoseBackend):
+    """
+    The real deal, requires an OpenPose build with the Python API
+    """
+
+    def __init__(self, model_path, net_resolution, render=True):
+        from openpose import pyopenpose
+        self.pyopenpose = pyopenpose
 
-class PoseEstimator(object):
-    def __init__(self, model_path, net_resolution):
         op = pyopenpose.WrapperPython()
 
         params = dict()
         params["model_folder"] = model_path
         params["face"] = False
         params["body"] = 1
-        params["render_pose"] = 1
+        params["render_pose"] = 1 if render else 0
         params["net_resolution"] = net_resolution
 
         op.configure(params)
         op.start()
         self.op = op
+        self.render = render
 
-    def grab_pose(self, frame):
-        datum = pyopenpose.Datum()
+    def estimate(self, frame):
+        datum = self.pyopenpose.Datum()
         datum.cvInputData = frame
         self.op.emplaceAndPop([datum])
-        return datum
+
+        key_points = datum.poseKeypoints
+        if key_points is None or key_points.ndim == 0:
+            key_points = empty_key_points()
+
+        return key_points, datum.cvOutputData if self.render else None
+
+
+class OpenCvBackend(PoseBackend):
+    """
+    Single person fallback for machines without an OpenPose build, runs the OpenPose BODY_25 Caffe model through
+    OpenCV's dnn module. That's the same full model, so it isn't any faster: there's no lightweight model here.
+
+    Only the part heatmaps are used, not the part affinity fields, so it finds a single person at most: the one with
+    the strongest neck. Only parts within `reach` times the frame height of that neck are taken, so a skeleton isn't
+    pieced together from several people. That's enough to try the game out on one's own, not to play it against each
+    other.
+    """
+
+    def __init__(self, model_path, net_resolution, threshold=0.1, reach=0.5):
+        model_dir = os.path.join(model_path, "pose", "body_25")
+        self.net = cv2.dnn.readNetFromCaffe(os.path.join(model_dir, "pose_deploy.prototxt"),
+                                            os.path.join(model_dir, "pose_iter_584000.caffemodel"))
+        self.net_resolution = net_resolution
+        self.threshold = threshold
+        self.reach = reach
+
+    def set_net_resolution(self, net_resolution):
+        self.net_resolution = net_resolution
+        return True
+
+    def estimate(self, frame):
+        height, width = frame.shape[:2]
+        net_size = parse_net_resolution(self.net_resolution, width, height)
+
+        # OpenPose normalizes its input to [-0.5, 0.5)
+        blob = cv2.dnn.blobFromImage(frame, 1.0 / 256, net_size, (128, 128, 128), swapRB=False, crop=False)
+        self.net.setInput(blob)
+        output = self.net.forward()
+        return self.find_person(output[0, :NUM_KEY_POINTS], width, height), None
+
+    def find_person(self, heatmaps, width, height):
+        """
+        Picks the key points of the person with the strongest neck from 25 part heatmaps, scaled to width x height
+        """
+        map_height, map_width = heatmaps.shape[1:]
+        neck_y, neck_x = np.unravel_index(np.argmax(heatmaps[NECK_IDX]), (map_height, map_width))
+        if heatmaps[NECK_IDX, neck_y, neck_x] <= self.threshold:
+            return empty_key_points()
+
+        ys, xs = np.ogrid[0:map_height, 0:map_width]
+        near = np.hypot(ys - neck_y, xs - neck_x) <= self.reach * map_height
+        heatmaps = np.where(near, heatmaps, -np.inf).reshape(NUM_KEY_POINTS, -1)
+        peaks = np.argmax(heatmaps, axis=1)
+        confidences = heatmaps[np.arange(NUM_KEY_POINTS), peaks]
+
+        key_points = np.zeros((1, NUM_KEY_POINTS, 3), dtype=np.float32)
+        key_points[0, :, 0] = (peaks % map_width + 0.5) * width / map_width
+        key_points[0, :, 1] = (peaks // map_width + 0.5) * height / map_height
+        key_points[0, :, 2] = np.where(confidences > self.threshold, confidences, 0)
+        return key_points
+
+
+class SyntheticBackend(PoseBackend):
+    """
+    Deterministic stand-in that produces scripted skeletons waving their arms, spread evenly over the frame.
+
+    The skeletons advance a fixed time step per call, so the same number of calls always yields the same poses.
+    `cost` seconds plus `cost_per_megapixel` seconds per million input pixels are spent per call to mimic a real
+    estimator.
+    """
+
+    def __init__(self, num_players=2, cost=0.0, cost_per_megapixel=0.0, time_step=DT, seed=0):
+        self.num_players = num_players
+        self.cost = cost
+        self.cost_per_megapixel = cost_per_megapixel
+        self.time_step = time_step
+        self.random = np.random.RandomState(seed)
+        self.phases = self.random.uniform(0, 2 * math.pi, size=(num_players, 2))
+        self.calls = 0
+
+    def set_net_resolution(self, net_resolution):
+        # Takes frames of any size, and its cost follows their size
+        return True
+
+    def estimate(self, frame):
+        height, width = frame.shape[:2]
+        delay = self.cost + self.cost_per_megapixel * width * height / 1e6
+        if delay > 0:
+            time.sleep(delay)
+
+        t = self.calls * self.time_step
+        self.calls += 1
+
+        return self.skeletons(t, width, height), None
+
+    def skeletons(self, t, width, height):
+        key_points = np.zeros((self.num_players, NUM_KEY_POINTS, 3), dtype=np.float32)
+        if self.num_players == 0:
+            return key_points
+
+        centers = (np.arange(self.num_players) + 1) * width / (self.num_players + 1)
+        shoulder_width = 0.4 * width / (self.num_players + 1)
+        upper_arm = 0.12 * height
+        forearm = 0.1 * height
+        neck_y = 0.35 * height
+
+        # One angle per arm, the right arm points to the left of the screen and vice versa
+        angles = math.pi / 2 + 0.9 * np.sin(2 * math.pi * 0.5 * t + self.phases)
+        directions = np.array([-1, 1])
+
+        def place(idx, x, y):
+            key_points[:, idx, 0] = x
+            key_points[:, idx, 1] = y
+            key_points[:, idx, 2] = 0.9
+
+        place(NOSE_IDX, centers, neck_y - 0.08 * height)
+        place(NECK_IDX, centers, neck_y)
+        place(MID_HIP_IDX, centers, neck_y + 0.3 * height)
+        for side, (shoulder, elbow, wrist) in enumerate([(RIGHT_SHOULDER_IDX, RIGHT_ELBOW_IDX, RIGHT_WRIST_IDX),
+                                                          (LEFT_SHOULDER_IDX, LEFT_ELBOW_IDX, LEFT_WRIST_IDX)]):
+            shoulder_x = centers + directions[side] * shoulder_width / 2
+            elbow_x = shoulder_x + directions[side] * upper_arm * np.sin(angles[:, side])
+            elbow_y = neck_y + upper_arm * np.cos(angles[:, side])
+            wrist_x = elbow_x + directions[side] * forearm * np.sin(2 * angles[:, side])
+            wrist_y = elbow_y - forearm * np.cos(2 * angles[:, side])
+            place(shoulder, shoulder_x, neck_y)
+            place(elbow, elbow_x, elbow_y)
+            place(wrist, wrist_x, wrist_y)
+
+        jitter = self.random.normal(0, 1.0, size=(self.num_players, NUM_KEY_POINTS, 2))
+        key_points[:, :, 0:2] += jitter * (key_points[:, :, 2:3] > 0)
+
+        return key_points
+
+
+class ReplayBackend(PoseBackend):
+    """
+    Replays a fixed sequence of key point arrays, one per call, starting over when it runs out
+    """
+
+    def __init__(self, sequence, cost=0.0):
+        self.sequence = list(sequence)
+        self.cost = cost
+        self.calls = 0
+
+    @staticmethod
+    def from_file(path, cost=0.0):
+        """
+        Loads a sequence stored with `np.savez(path, *sequence)`
+        """
+        with np.load(path) as data:
+            sequence = [data['arr_%d' % i] for i in range(len(data.files))]
+
+        return ReplayBackend(sequence, cost)
+
+    def estimate(self, frame):
+        if self.cost > 0:
+            time.sleep(self.cost)
+
+        if not self.sequence:
+            return empty_key_points(), None
+
+        key_points = self.sequence[self.calls % len(self.sequence)]
+        self.calls += 1
+        return key_points, None
+
+
+def create_backend(name, model_path=None, net_resolution=None, num_players=2, cost=0.0, replay_path=None,
+                   render=True):
+    """
+    Instantiates one of the BACKENDS by name. Only OpenPose renders, unless `render` is off.
+    """
+    if name == 'openpose':
+        return OpenPoseBackend(model_path, net_resolution, render)
+    elif name == 'opencv':
+        return OpenCvBackend(model_path, net_resolution)
+    elif name == 'synthetic':
+        return SyntheticBackend(num_players, cost)
+    elif name == 'replay':
+        return ReplayBackend.from_file(replay_path, cost)
+
+    raise ValueError("Unknown pose backend: " + name)
+
+
+class RegionOfInterest(object):
+    """
+    Crops frames to the area around the skeletons found in the previous frame.
+
+    The full frame is used again every `full_frame_interval` frames, when nothing was found, or when the crop wouldn't
+    save much, so new players are picked up. The crop is kept as fractions of the image, so it still fits when the
+    images change size, like when the scheduler switches resolutions.
+    """
+
+    def __init__(self, margin=ROI_MARGIN, full_frame_interval=ROI_FULL_FRAME_INTERVAL,
+                 max_area_fraction=ROI_MAX_AREA_FRACTION):
+        self.margin = margin
+        self.full_frame_interval = full_frame_interval
+        self.max_area_fraction = max_area_fraction
+        self.box = None
+        self.frames_since_full = 0
+
+    def crop(self, image):
+        """
+        Returns the part of the image to run the estimator on, and the (x, y) offset of that part
+        """
+        if self.box is None or self.frames_since_full >= self.full_frame_interval:
+            self.frames_since_full = 0
+            return image, (0, 0)
+
+        self.frames_since_full += 1
+        height, width = image.shape[0:2]
+        x0, y0 = int(self.box[0] * width), int(self.box[1] * height)
+        x1, y1 = int(math.ceil(self.box[2] * width)), int(math.ceil(self.box[3] * height))
+        return image[y0:y1, x0:x1], (x0, y0)
+
+    def update(self, key_points, width, height):
+        """
+        Sets the next crop from the key points found in a width x height frame
+        """
+        found = key_points[:, :, 2] > 0
+        if not np.any(found):
+            self.box = None
+            return
+
+        xs = key_points[:, :, 0][found]
+        ys = key_points[:, :, 1][found]
+        margin_x = self.margin * max(xs.max() - xs.min(), 0.25 * width)
+        margin_y = self.margin * max(ys.max() - ys.min(), 0.25 * height)
+        x0 = int(max(xs.min() - margin_x, 0))
+        y0 = int(max(ys.min() - margin_y, 0))
+        x1 = int(min(xs.max() + margin_x, width))
+        y1 = int(min(ys.max() + margin_y, height))
+
+        if (x1 - x0) * (y1 - y0) > self.max_area_fraction * width * height:
+            self.box = None
+        else:
+            self.box = (x0 / float(width), y0 / float(height), x1 / float(width), y1 / float(height))
+
+
+class PoseEstimator(object):
+    """
+    Estimates poses using the given backend
+    """
+
+    def __init__(self, backend, roi=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.backend = backend
+        self.roi = roi
+        self.logger.info("Using %s", backend.__class__.__name__)
+
+    def estimate(self, frame):
+        """
+        Estimates the poses in a CapturedFrame, on its downscaled inference image if it has one and cropped to the
+        region of interest if enabled. Returns a PoseEstimate with key points in the coordinates of the full frame.
+        """
+        image = frame.inference_image if frame.inference_image is not None else frame.image
+        height, width = image.shape[0:2]
+
+        offset = (0, 0)
+        cropped = image
+        if self.roi:
+            cropped, offset = self.roi.crop(image)
+
+        key_points, output_frame = self.backend.estimate(cropped)
+        key_points = np.array(key_points, dtype=np.float32)
+        found = key_points[:, :, 2:3] > 0
+        key_points[:, :, 0:2] += np.where(found, offset, 0)
+        if self.roi:
+            self.roi.update(key_points, width, height)
+
+        scale_x = frame.image.shape[1] / float(width)
+        scale_y = frame.image.shape[0] / float(height)
+        key_points[:, :, 0] *= scale_x
+        key_points[:, :, 1] *= scale_y
+
+        if output_frame is None:
+            output_frame = frame.image
+        elif output_frame.shape != frame.image.shape:
+            output_frame = self.paste_render(frame.image, output_frame, offset, scale_x, scale_y)
+
+        return PoseEstimate(key_points, output_frame)
+
+    @staticmethod
+    def paste_render(image, rendered, offset, scale_x, scale_y):
+        """
+        Returns a copy of the full frame `image` with the backend's render of a crop or downscaled version of it pasted
+        in, scaled back up and at the crop's `offset`
+        """
+        output_frame = image.copy()
+        x0, y0 = int(round(offset[0] * scale_x)), int(round(offset[1] * scale_y))
+        x1 = min(int(round((offset[0] + rendered.shape[1]) * scale_x)), image.shape[1])
+        y1 = min(int(round((offset[1] + rendered.shape[0]) * scale_y)), image.shape[0])
+        if x1 > x0 and y1 > y0:
+            cv2.resize(rendered, (x1 - x0, y1 - y0), dst=output_frame[y0:y1, x0:x1])
+        return output_frame
@@ -0,0 +1,240 @@
+"""
+Recording and replaying of play sessions: camera frames and pose key points with their timestamps.
+
+A session file is a zip archive with a JPEG per frame, an .npy file per pose result and an index.json listing both.
+
+@author: Jeroen Vlek <j.vlek@anchormen.nl>
+"""
+
+import io
+import json
+import logging
+import queue
+import threading
+import time
+import zipfile
+
+import cv2
+import numpy as np
+
+from camera import CapturedFrame
+from inference import PoseResult
+
+FRAME_NAME = "frames/%08d.jpg"
+POSE_NAME = "poses/%08d.npy"
+INDEX_NAME = "index.json"
+
+
+class SessionRecorder(threading.Thread):
+    """
+    Writes frames and poses to a session file on a background thread, so recording doesn't stall capture or the game.
+
+    Records are dropped, and counted, when the writer can't keep up.
+    """
+
+    def __init__(self, path, jpeg_quality=90, max_pending=64):
+        super().__init__(daemon=True)
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.jpeg_quality = jpeg_quality
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.frames = []
+        self.poses = []
+        self.dropped = 0
+        self.running = True
+
+    def record_frame(self, frame):
+        """
+        Records a CapturedFrame
+        """
+        self._enqueue(('frame', frame.seq, frame.timestamp, frame.image))
+
+    def record_pose(self, seq, timestamp, key_points):
+        """
+        Records the key points found in frame `seq`, captured at `timestamp`
+        """
+        self._enqueue(('pose', seq, timestamp, key_points))
+
+    def _enqueue(self, record):
+        try:
+            self.pending.put_nowait(record + (time.monotonic(),))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        self.logger.info("Recording session to %s", self.path)
+
+        with zipfile.ZipFile(self.path, 'w') as archive:
+            while self.running or not self.pending.empty():
+                try:
+                    kind, seq, timestamp, data, recorded_at = self.pending.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                if kind == 'frame':
+                    _, encoded = cv2.imencode('.jpg', data, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+                    archive.writestr(FRAME_NAME % seq, encoded.tobytes(), zipfile.ZIP_STORED)
+                    self.frames.append([seq, timestamp])
+                else:
+                    buffer = io.BytesIO()
+                    np.save(buffer, np.asarray(data, dtype=np.float32))
+                    archive.writestr(POSE_NAME % len(self.poses), buffer.getvalue(), zipfile.ZIP_DEFLATED)
+                    self.poses.append([seq, timestamp, recorded_at])
+
+            index = {"frames": self.frames, "poses": self.poses}
+            archive.writestr(INDEX_NAME, json.dumps(index), zipfile.ZIP_DEFLATED)
+
+        self.logger.info("Recorded %d frames and %d poses, dropped %d records",
+                         len(self.frames), len(self.poses), self.dropped)
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+class SessionReader(object):
+    """
+    Random access to the frames and poses of a recorded session
+    """
+
+    def __init__(self, path):
+        self.archive = zipfile.ZipFile(path, 'r')
+        index = json.loads(self.archive.read(INDEX_NAME).decode('utf-8'))
+
+        # (seq, capture timestamp)
+        self.frames = [tuple(frame) for frame in index["frames"]]
+        # (frame seq, capture timestamp, time the pose was applied)
+        self.poses = [tuple(pose) for pose in index["poses"]]
+        self.frame_seqs = set(seq for seq, _ in self.frames)
+        self.decoded = (None, None)
+
+        timestamps = [timestamp for _, timestamp in self.frames] + [pose[2] for pose in self.poses]
+        self.start_time = min(timestamps) if timestamps else 0.0
+        self.end_time = max(timestamps) if timestamps else 0.0
+
+    def duration(self):
+        return self.end_time - self.start_time
+
+    def frame(self, seq):
+        """
+        Decodes the frame with sequence number `seq`, or returns None if it wasn't recorded
+        """
+        if seq not in self.frame_seqs:
+            return None
+
+        # Keep the last decoded frame around, so it can be decoded ahead of time
+        if self.decoded[0] != seq:
+            encoded = np.frombuffer(self.archive.read(FRAME_NAME % seq), dtype=np.uint8)
+            self.decoded = (seq, cv2.imdecode(encoded, cv2.IMREAD_COLOR))
+
+        return self.decoded[1]
+
+    def key_points(self, idx):
+        """
+        Loads the key points of the idx-th pose result
+        """
+        return np.load(io.BytesIO(self.archive.read(POSE_NAME % idx)))
+
+    def close(self):
+        self.archive.close()
+
+
+class ReplayClock(object):
+    """
+    Session time. Follows the wall clock (optionally sped up) in real time mode, otherwise only moves when advanced.
+    """
+
+    def __init__(self, start_time, real_time=False, speed=1.0):
+        self.real_time = real_time
+        self.speed = speed
+        self.time = start_time
+        self.wall_start = time.monotonic()
+        self.start_time = start_time
+
+    def now(self):
+        if self.real_time:
+            return self.start_time + (time.monotonic() - self.wall_start) * self.speed
+
+        return self.time
+
+    def advance_to(self, timestamp):
+        self.time = max(self.time, timestamp)
+
+
+class ReplayGrabber(object):
+    """
+    Stands in for the FrameGrabber, handing out the recorded frames as their capture time passes on the clock
+    """
+
+    def __init__(self, reader, clock):
+        self.reader = reader
+        self.clock = clock
+        self.next_idx = 0
+
+    def next_event(self):
+        """
+        The (frame seq, timestamp) of the next frame to be handed out, or None at the end of the session
+        """
+        if self.next_idx >= len(self.reader.frames):
+            return None
+
+        return self.reader.frames[self.next_idx]
+
+    def pop_frame(self):
+        now = self.clock.now()
+        newest = None
+        while self.next_idx < len(self.reader.frames) and self.reader.frames[self.next_idx][1] <= now:
+            newest = self.reader.frames[self.next_idx]
+            self.next_idx += 1
+
+        if newest is None:
+            return None
+
+        seq, timestamp = newest
+        return CapturedFrame(seq, timestamp, self.reader.frame(seq))
+
+    def stop(self):
+        pass
+
+
+class ReplayInference(object):
+    """
+    Stands in for the InferenceWorker, handing out the recorded poses at the time they were originally applied
+    """
+
+    def __init__(self, reader, clock):
+        self.reader = reader
+        self.clock = clock
+        self.next_idx = 0
+        self.output_frame = None
+
+    def next_event(self):
+        """
+        The (frame seq, timestamp) of the next pose to be handed out, or None at the end of the session
+        """
+        if self.next_idx >= len(self.reader.poses):
+            return None
+
+        seq, _, applied_at = self.reader.poses[self.next_idx]
+        return seq, applied_at
+
+    def pop_result(self):
+        now = self.clock.now()
+        newest = None
+        while self.next_idx < len(self.reader.poses) and self.reader.poses[self.next_idx][2] <= now:
+            newest = self.next_idx
+            self.next_idx += 1
+
+        if newest is None:
+            return None
+
+        seq, timestamp, applied_at = self.reader.poses[newest]
+        frame = self.reader.frame(seq)
+        if frame is not None:
+            self.output_frame = frame
+
+        return PoseResult(seq, timestamp, self.reader.key_points(newest), self.output_frame, applied_at - timestamp)
+
+    def stop(self):
+        pass
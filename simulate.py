@@ -0,0 +1,180 @@
+"""
+Headless simulation of many games with scripted players, to tune the gameplay constants without a camera.
+
+Every combination of the given constant values is played `--games` times, spread over a process pool, and reported
+with its goals per minute and the distribution of the logo's speed.
+
+Usage: python3 simulate.py --games 1000 --duration 60 --set DAMPING=0.5,0.8 --set LOGO_ELASTICITY=0.8,1.0
+
+@author: Jeroen Vlek <j.vlek@anchormen.nl>
+"""
+
+import argparse
+import ast
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import numpy as np
+
+import constants
+import entities
+import physics
+from entities import PlayerStore
+from physics import World
+from pose_estimator import SyntheticBackend
+
+# Modules that copy the constants into their own namespace with `from constants import *`
+TUNED_MODULES = (constants, entities, physics)
+DEFAULTS = dict((name, getattr(constants, name)) for name in dir(constants) if name.isupper())
+
+# Logo speeds are counted in bins of 20 pixels per second, anything faster ends up in the last bin
+SPEED_BINS = np.arange(0, 4001, 20)
+
+
+def apply_overrides(overrides):
+    """
+    Sets the given constants, and all others back to their defaults, in every module that uses them. Only values that
+    are looked up while playing are affected, not the defaults of function arguments.
+    """
+    unknown = set(overrides) - set(DEFAULTS)
+    if unknown:
+        raise ValueError("Unknown constants: " + ", ".join(sorted(unknown)))
+
+    values = dict(DEFAULTS)
+    values.update(overrides)
+    for module in TUNED_MODULES:
+        for name, value in values.items():
+            if hasattr(module, name):
+                setattr(module, name, value)
+
+
+def simulate_game(overrides, seed, duration, num_players, screen_dims):
+    """
+    Plays one game of `duration` seconds with scripted players waving their arms and swaying from side to side.
+    Returns the number of goals and a histogram of the logo's speed per physics step.
+    """
+    apply_overrides(overrides)
+    dt = constants.DT
+    rng = random.Random(seed)
+
+    world = World(screen_dims)
+    world.spawn_logo(rng)
+    backend = SyntheticBackend(num_players, time_step=dt, seed=seed)
+    store = PlayerStore(world.push_bodies)
+    players = [store.add(track_id) for track_id in range(num_players)]
+
+    width, height = screen_dims
+    sway = np.array([[0.15 * width * rng.random(), 0.1 * height * rng.random(), rng.uniform(0.05, 0.3),
+                      rng.uniform(0, 2 * math.pi)] for _ in range(num_players)]).reshape(num_players, 4)
+
+    steps = int(duration / dt)
+    speeds = np.empty(steps)
+    for step in range(steps):
+        t = step * dt
+        key_points = backend.skeletons(t, width, height)
+        phase = 2 * math.pi * sway[:, 2] * t + sway[:, 3]
+        key_points[:, :, 0] += (sway[:, 0] * np.sin(phase))[:, np.newaxis]
+        key_points[:, :, 1] += (sway[:, 1] * np.cos(phase))[:, np.newaxis]
+        store.update_poses(players, key_points, dt)
+
+        world.space.step(dt)
+        speeds[step] = world.logo_box.body.velocity.length
+
+    histogram, _ = np.histogram(np.minimum(speeds, SPEED_BINS[-1] - 1), SPEED_BINS)
+    return {"overrides": overrides, "seed": seed, "duration": steps * dt,
+            "goals": world.left_goal.counter.score + world.right_goal.counter.score, "speeds": histogram}
+
+
+def _simulate_task(task):
+    return simulate_game(*task)
+
+
+def histogram_percentiles(histogram, percentiles):
+    cumulative = np.cumsum(histogram) / float(max(histogram.sum(), 1))
+    centers = (SPEED_BINS[:-1] + SPEED_BINS[1:]) / 2.0
+    return [float(centers[min(np.searchsorted(cumulative, p / 100.0), len(centers) - 1)]) for p in percentiles]
+
+
+def summarize(results):
+    """
+    Aggregates the results of all games played with the same overrides
+    """
+    goals_per_minute = np.array([result["goals"] * 60.0 / result["duration"] for result in results])
+    speeds = np.sum([result["speeds"] for result in results], axis=0)
+    centers = (SPEED_BINS[:-1] + SPEED_BINS[1:]) / 2.0
+    p50, p90, p99 = histogram_percentiles(speeds, [50, 90, 99])
+
+    return {"overrides": results[0]["overrides"],
+            "games": len(results),
+            "goals_per_minute": {"mean": float(goals_per_minute.mean()), "std": float(goals_per_minute.std()),
+                                 "min": float(goals_per_minute.min()), "max": float(goals_per_minute.max())},
+            "logo_speed": {"mean": float(np.dot(speeds, centers) / max(speeds.sum(), 1)),
+                           "p50": p50, "p90": p90, "p99": p99}}
+
+
+def parse_grid(assignments):
+    """
+    Turns ["NAME=1,2", "OTHER=0.5"] into a list of override dicts, one per combination of values
+    """
+    names = []
+    value_lists = []
+    for assignment in assignments:
+        name, values = assignment.split("=", 1)
+        names.append(name.strip())
+        value_lists.append([ast.literal_eval(value.strip()) for value in values.split(",")])
+
+    return [dict(zip(names, values)) for values in itertools.product(*value_lists)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plays many headless games to tune the constants')
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE[,VALUE...]",
+                        help="Constant to override, every combination of the given values is played")
+    parser.add_argument("--games", type=int, default=100, help="Games per combination of values")
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds per game")
+    parser.add_argument("--players", type=int, default=2, help="Scripted players per game")
+    parser.add_argument('--width', type=int, default=1280, help='Field width')
+    parser.add_argument('--height', type=int, default=720, help='Field height')
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(), help="Size of the process pool")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the first game")
+    parser.add_argument("--json", action="store_true", help="If provided, prints a JSON line per combination")
+    args = parser.parse_args()
+
+    grid = parse_grid(args.set)
+    # Fail early on unknown names
+    for overrides in grid:
+        apply_overrides(overrides)
+    apply_overrides({})
+    tasks = [(overrides, args.seed + game, args.duration, args.players, (args.width, args.height))
+             for overrides in grid for game in range(args.games)]
+
+    start = time.perf_counter()
+    results = dict((json.dumps(overrides, sort_keys=True), []) for overrides in grid)
+    pool = multiprocessing.Pool(args.processes)
+    for result in pool.imap_unordered(_simulate_task, tasks, chunksize=max(1, len(tasks) // (args.processes * 8))):
+        results[json.dumps(result["overrides"], sort_keys=True)].append(result)
+    pool.close()
+    pool.join()
+    elapsed = time.perf_counter() - start
+
+    for key in sorted(results):
+        report = summarize(results[key])
+        if args.json:
+            print(json.dumps(report))
+        else:
+            print(", ".join("%s=%r" % item for item in sorted(report["overrides"].items())) or "defaults")
+            print("  games                %d" % report["games"])
+            for name in ("goals_per_minute", "logo_speed"):
+                print("  %-20s %s" % (name, "  ".join("%s=%.2f" % item for item in report[name].items())))
+
+    if not args.json:
+        print("Simulated %.0f game seconds in %.1f s, %.0fx real time" %
+              (len(tasks) * args.duration, elapsed, len(tasks) * args.duration / elapsed))
@@ -0,0 +1,65 @@
+"""
+Starting the game in stages that run side by side, so it's playable as soon as possible after a restart.
+
+@author: Jeroen Vlek <j.vlek@anchormen.nl>
+"""
+
+import concurrent.futures
+import logging
+import time
+
+from metrics import registry
+
+
+class Startup(object):
+    """
+    Runs the slow steps of starting the game, like loading the model, opening the camera and finding the fonts, on
+    threads of their own while the main thread sets up the display.
+
+    Every stage is a future, a stage can wait for another one through `result`. The time from the start until each
+    stage was ready is logged and exported as a startup.<stage> gauge.
+    """
+
+    def __init__(self, max_workers=4):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.started = time.monotonic()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix="startup")
+        self.stages = {}
+
+    def submit(self, name, func, *args, **kwargs):
+        """
+        Starts running func(*args, **kwargs) as stage `name`, returns its future
+        """
+        self.stages[name] = self.executor.submit(self._run, name, func, args, kwargs)
+        return self.stages[name]
+
+    def _run(self, name, func, args, kwargs):
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.logger.exception("Stage %s failed", name)
+            raise
+
+        self.mark(name, time.monotonic() - start)
+        return result
+
+    def result(self, name, timeout=None):
+        """
+        Waits for stage `name` and returns its result, or raises what it raised
+        """
+        return self.stages[name].result(timeout)
+
+    def mark(self, name, duration=None):
+        """
+        Records that `name` was reached, also for milestones that aren't stages, like the first frame on screen
+        """
+        elapsed = time.monotonic() - self.started
+        if duration is None:
+            self.logger.info("%s ready %.2f s after start", name, elapsed)
+        else:
+            self.logger.info("%s ready %.2f s after start, took %.2f s", name, elapsed, duration)
+        registry.set_gauge("startup." + name, elapsed)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,31 @@
+"""
+Checks that the constants simulate.py overrides actually change how a game is played.
+
+Run with: python3 -m pytest test_simulate.py
+
+@author: Jeroen Vlek <j.vlek@anchormen.nl>
+"""
+
+import numpy as np
+
+import simulate
+
+
+def play(overrides):
+    try:
+        return simulate.simulate_game(overrides, 0, 10.0, 2, (1280, 720))
+    finally:
+        simulate.apply_overrides({})
+
+
+def test_hand_forearm_ratio_changes_the_game():
+    short_hands = play({"HAND_FOREARM_RATIO": 0.5})
+    long_hands = play({"HAND_FOREARM_RATIO": 4.0})
+    assert not np.array_equal(short_hands["speeds"], long_hands["speeds"])
+
+
+def test_defaults_are_deterministic():
+    first = play({})
+    second = play({})
+    assert first["goals"] == second["goals"]
+    assert np.array_equal(first["speeds"], second["speeds"])
@@ -0,0 +1,121 @@
+"""
+Matches the poses detected in a frame to the players of the previous frame, so players keep their identity.
+
+@author: Jeroen Vlek <j.vlek@anchormen.nl>
+"""
+
+import itertools
+
+import numpy as np
+
+from constants import *
+
+
+def pose_distances(poses, references, key_point_ids=TRACKING_KEY_POINTS):
+    """
+    Computes the N x M matrix of mean distances between N poses and M reference poses, over the given key points that
+    were found in both. Pairs without any key point in common are infinitely far apart.
+    """
+    poses = np.asarray(poses)[:, key_point_ids]
+    references = np.asarray(references)[:, key_point_ids]
+
+    found = (poses[:, np.newaxis, :, 2] > 0) & (references[np.newaxis, :, :, 2] > 0)
+    distances = np.linalg.norm(poses[:, np.newaxis, :, 0:2] - references[np.newaxis, :, :, 0:2], axis=-1)
+
+    counts = found.sum(axis=-1)
+    totals = np.where(found, distances, 0).sum(axis=-1)
+    return np.where(counts > 0, totals / np.maximum(counts, 1), np.inf)
+
+
+def linear_assignment(cost):
+    """
+    Solves the rectangular assignment problem for a finite cost matrix with the Hungarian method (shortest augmenting
+    paths, O(n^2 m)). Returns the matched row and column indices, every row or every column is matched.
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+
+    num_rows, num_cols = cost.shape
+    # Potentials and assignments are 1-based, column 0 is a virtual column used to start each augmenting path
+    row_potentials = np.zeros(num_rows + 1)
+    col_potentials = np.zeros(num_cols + 1)
+    col_to_row = np.zeros(num_cols + 1, dtype=np.int64)
+    way = np.zeros(num_cols + 1, dtype=np.int64)
+
+    for row in range(1, num_rows + 1):
+        col_to_row[0] = row
+        col = 0
+        min_slack = np.full(num_cols + 1, np.inf)
+        used = np.zeros(num_cols + 1, dtype=bool)
+
+        while col_to_row[col] != 0:
+            used[col] = True
+            current_row = col_to_row[col]
+            free = ~used[1:]
+
+            slack = cost[current_row - 1] - row_potentials[current_row] - col_potentials[1:]
+            improved = free & (slack < min_slack[1:])
+            min_slack[1:][improved] = slack[improved]
+            way[1:][improved] = col
+
+            candidates = np.where(free, min_slack[1:], np.inf)
+            next_col = int(np.argmin(candidates)) + 1
+            delta = candidates[next_col - 1]
+
+            row_potentials[col_to_row[used]] += delta
+            col_potentials[used] -= delta
+            min_slack[1:][free] -= delta
+            col = next_col
+
+        # Flip the augmenting path
+        while col != 0:
+            previous_col = way[col]
+            col_to_row[col] = col_to_row[previous_col]
+            col = previous_col
+
+    cols = np.nonzero(col_to_row[1:])[0]
+    rows = col_to_row[1:][cols] - 1
+    order = np.argsort(rows)
+    rows, cols = rows[order], cols[order]
+
+    if transposed:
+        rows, cols = cols, rows
+        order = np.argsort(rows)
+        rows, cols = rows[order], cols[order]
+
+    return rows, cols
+
+
+class PoseTracker(object):
+    """
+    Assigns poses to players globally, minimizing the summed distance, and hands out track ids for new players
+    """
+
+    def __init__(self, max_distance=MAX_DISTANCE_THRESHOLD):
+        self.max_distance = max_distance
+        self.track_ids = itertools.count(1)
+
+    def new_track_id(self):
+        return next(self.track_ids)
+
+    def match(self, poses, players):
+        """
+        Returns, per pose, the player it belongs to or None if it's too far from every player (gating)
+        """
+        matches = [None] * len(poses)
+        if len(poses) == 0 or not players:
+            return matches
+
+        distances = pose_distances(poses, [player.key_points for player in players])
+
+        # Pairs beyond the gate cost more than any set of pairs within it, so they're only assigned when nothing else is
+        # left, and are rejected afterwards
+        gate_cost = self.max_distance * (min(distances.shape) + 1)
+        gated = np.where(distances <= self.max_distance, distances, gate_cost)
+        for pose_idx, player_idx in zip(*linear_assignment(gated)):
+            if distances[pose_idx, player_idx] <= self.max_distance:
+                matches[pose_idx] = players[player_idx]
+
+        return matches